@@ -0,0 +1,213 @@
+#!/usr/bin/python3 -u
+'''
+性能评估: 分别统计读取数据、生成报告、规则检查及 html 输出各阶段的耗时
+'''
+import os
+import sys
+import json
+import time
+import resource
+import tempfile
+import statistics
+import subprocess
+from optparse import OptionParser
+
+import jmStockAnalysis as jm
+import genSyntheticDb
+
+STAGES = ('load', 'report', 'check', 'render')
+
+def run_benchmark(database, tickers, cache='off'):
+    '''
+    对每个股票依次执行各阶段，统计耗时
+
+    Args:
+        database: Path of database
+        tickers: List of (ticker, exchange)
+        cache: Cache mode, one of jmStockAnalysis.CACHE_MODES
+    Returns:
+        Dict of results: seconds of each stage, tickers per second and peak memory in MB
+    '''
+    seconds = dict.fromkeys(STAGES, 0.0)
+    db = jm.open_readonly(database)
+    try:
+        # 预热，第一次访问时需初始化 pandas 及 numpy 的部分模块
+        if tickers:
+            ticker, exchange = tickers[0]
+            jm.render_report(jm.AnalysisBase(db, ticker, exchange), ticker)
+
+        for ticker, exchange in tickers:
+            t0 = time.perf_counter()
+            ticker_analysis = jm.AnalysisBase(db, ticker, exchange, jm.make_cache(database, cache))
+            for name in jm.LINE_ITEMS:
+                getattr(ticker_analysis, name)
+            t1 = time.perf_counter()
+            report = ticker_analysis.generate_report()
+            t2 = time.perf_counter()
+            styles = jm.CheckRules(report).style_matrix()
+            t3 = time.perf_counter()
+            jm.html_table(report, styles, ticker)
+            t4 = time.perf_counter()
+
+            seconds['load'] += t1 - t0
+            seconds['report'] += t2 - t1
+            seconds['check'] += t3 - t2
+            seconds['render'] += t4 - t3
+    finally:
+        db.close()
+
+    total = sum(seconds.values())
+    return {
+        'tickers': len(tickers),
+        'seconds': seconds,
+        'total': total,
+        'tickers_per_second': len(tickers) / total if total else 0.0,
+        # ru_maxrss is in KB on Linux
+        'peak_memory_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+def print_results(results, baseline=None):
+    print(f"{'stage':<10}{'seconds':>10}{'ms/ticker':>12}" + (f"{'baseline':>12}{'ratio':>8}" if baseline else ''))
+    n = results['tickers']
+    for stage in STAGES + ('total',):
+        sec = results['total'] if stage == 'total' else results['seconds'][stage]
+        line = f"{stage:<10}{sec:>10.3f}{sec / n * 1000:>12.2f}"
+        if baseline:
+            base = baseline['total'] if stage == 'total' else baseline['seconds'][stage]
+            base = base / baseline['tickers'] * n
+            line += f"{base:>12.3f}{sec / base if base else float('inf'):>8.2f}"
+        print(line)
+    print(f"{n} tickers, {results['tickers_per_second']:.1f} tickers/s, "
+          f"peak memory {results['peak_memory_mb']:.1f} MB")
+
+def regressions(results, baseline, tolerance):
+    '''
+    比较基准，返回单个股票耗时超过基准 (1 + tolerance) 倍的阶段
+    '''
+    slow = []
+    for stage in STAGES:
+        current = results['seconds'][stage] / results['tickers']
+        base = baseline['seconds'][stage] / baseline['tickers']
+        if base and current > base * (1 + tolerance):
+            slow.append((stage, current / base))
+    return slow
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jmStockAnalysis.py')
+
+def run_startup(tmp, runs=10, tickers=10):
+    '''
+    命令行启动耗时: 只导入模块、--help，以及所有报告都未改变的批量任务，
+    每个命令在新进程中运行多次
+
+    Args:
+        tmp: Temporary directory for the synthetic database and reports
+        runs: Number of runs of each command
+        tickers: Number of tickers in the batch
+    Returns:
+        Dict of {command: {'min_ms', 'median_ms', 'pandas'}}, pandas is whether pandas was imported
+    '''
+    database = os.path.join(tmp, 'startup.db3')
+    manifest = os.path.join(tmp, 'startup.manifest')
+    genSyntheticDb.generate_database(database, genSyntheticDb.ticker_names(tickers))
+    with open(manifest, 'w') as file:
+        for ticker in genSyntheticDb.ticker_names(tickers):
+            file.write(f"{ticker} {database} {os.path.join(tmp, ticker)}.html\n")
+    # 第一次生成所有报告，之后的批量任务全部跳过
+    subprocess.run([sys.executable, SCRIPT, '-m', manifest], check=True, capture_output=True)
+
+    commands = {
+        'import': [sys.executable, '-c', 'import jmStockAnalysis'],
+        'help': [sys.executable, SCRIPT, '--help'],
+        'help -m': [sys.executable, '-m', 'jmStockAnalysis', '--help'],
+        'batch fresh': [sys.executable, SCRIPT, '-m', manifest],
+    }
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(SCRIPT))
+    results = {}
+    for name, command in commands.items():
+        seconds = []
+        for _ in range(runs):
+            t0 = time.perf_counter()
+            subprocess.run(command, check=True, capture_output=True, env=env)
+            seconds.append(time.perf_counter() - t0)
+        # 导入 pandas 时 -X importtime 会列出其子模块
+        trace = subprocess.run([sys.executable, '-X', 'importtime'] + command[1:],
+                               check=True, capture_output=True, text=True, env=env).stderr
+        results[name] = {
+            'min_ms': min(seconds) * 1000,
+            'median_ms': statistics.median(seconds) * 1000,
+            'pandas': 'pandas.core' in trace,
+        }
+    return results
+
+def print_startup(results):
+    print(f"{'command':<14}{'min ms':>10}{'median ms':>12}{'pandas':>8}")
+    for name, result in results.items():
+        print(f"{name:<14}{result['min_ms']:>10.1f}{result['median_ms']:>12.1f}"
+              f"{'yes' if result['pandas'] else 'no':>8}")
+
+def main():
+    parser = OptionParser()
+
+    parser.add_option("--db", "--database",
+                action="store", dest="database",
+                help="Finance database, a synthetic one is generated if not given")
+    parser.add_option("-n", "--tickers",
+                action="store", dest="tickers", type="int", default=100,
+                help="Number of tickers to benchmark, default 100")
+    parser.add_option("--cache",
+                action="store", dest="cache", default='off', choices=jm.CACHE_MODES,
+                help="Cache mode, one of on, off, rebuild, default off")
+    parser.add_option("--save",
+                action="store", dest="save",
+                help="Save results as a baseline json")
+    parser.add_option("--baseline",
+                action="store", dest="baseline",
+                help="Compare with a saved baseline json")
+    parser.add_option("--tolerance",
+                action="store", dest="tolerance", type="float", default=0.2,
+                help="Allowed slowdown against baseline, default 0.2 (20%)")
+    parser.add_option("--startup",
+                action="store_true", dest="startup", default=False,
+                help="Benchmark command line startup time instead, -n is the number of runs")
+
+    (opts, args) = parser.parse_args()
+
+    if opts.startup:
+        with tempfile.TemporaryDirectory() as tmp:
+            results = run_startup(tmp, opts.tickers)
+        print_startup(results)
+        if opts.save:
+            with open(opts.save, 'w') as file:
+                json.dump(results, file, indent=2)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database = opts.database
+        if database is None:
+            database = os.path.join(tmp, 'synthetic.db3')
+            genSyntheticDb.generate_database(database, genSyntheticDb.ticker_names(opts.tickers))
+
+        tickers = jm.list_tickers(jm.open_readonly(database))[:opts.tickers]
+        results = run_benchmark(database, tickers, opts.cache)
+
+    baseline = None
+    if opts.baseline:
+        with open(opts.baseline) as file:
+            baseline = json.load(file)
+
+    print_results(results, baseline)
+
+    if opts.save:
+        with open(opts.save, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if baseline:
+        slow = regressions(results, baseline, opts.tolerance)
+        for stage, ratio in slow:
+            print(f"Regression: {stage} is {ratio:.2f}x of baseline", file=sys.stderr)
+        if slow:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+#!/usr/bin/python3 -u
+'''
+生成与 msfinance 相同表名及表头格式的模拟数据库，用于测试及性能评估
+'''
+import sqlite3
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from optparse import OptionParser
+
+# 各表的行: (表头, 数值范围)，表头缩进与 msfinance 相同
+INCOME_STATEMENT = [
+    ('Total Revenue',                                   (1e3, 1e6)),
+    ('    Cost of Revenue',                             (1e3, 5e5)),
+    ('Gross Profit',                                    (1e3, 5e5)),
+    ('Operating Income/Expenses',                       (-1e5, 0)),
+    ('Total Operating Profit/Loss',                     (-1e4, 2e5)),
+    ('Net Income Available to Common Stockholders',     (-1e4, 2e5)),
+    ('Basic EPS',                                       (-1, 10)),
+    ('Diluted EPS',                                     (-1, 10)),
+]
+
+BALANCE_SHEET = [
+    ('Total Assets',                                                (1e5, 1e6)),
+    ('    Total Current Assets',                                    (1e4, 5e5)),
+    ('        Cash, Cash Equivalents and Short Term Investments',   (1e4, 2e5)),
+    ('            Cash and Cash Equivalents',                       (1e4, 1e5)),
+    ('        Trade and Other Receivables, Current',                (1e3, 1e5)),
+    ('        Inventories',                                         (1e3, 1e5)),
+    ('    Total Non-Current Assets',                                (1e4, 5e5)),
+    ('        Net Property, Plant and Equipment',                   (1e4, 3e5)),
+    ('        Total Long Term Investments',                         (1e3, 1e5)),
+    ('Total Liabilities',                                           (1e4, 6e5)),
+    ('    Total Current Liabilities',                               (1e4, 3e5)),
+    ('    Total Non-Current Liabilities',                           (1e4, 3e5)),
+    ('Total Equity',                                                (1e4, 5e5)),
+    ('Total Liabilities and Equity',                                (1e5, 1e6)),
+]
+
+CASH_FLOW = [
+    ('Cash Flow from Operating Activities, Indirect',                               (-1e4, 3e5)),
+    ('Cash Flow from Investing Activities',                                         (-2e5, 1e4)),
+    ('        Purchase/Sale and Disposal of Property, Plant and Equipment, Net',    (-1e5, 0)),
+    ('Cash Flow from Financing Activities',                                         (-2e5, 1e5)),
+    ('                Repayments for Short Term Debt',                              (-5e4, 0)),
+    ('                Repayments for Long Term Debt',                               (-5e4, 0)),
+    ('        Cash Dividends and Interest Paid',                                    (-5e4, 0)),
+    ('Free Cash Flow',                                                              (-1e4, 2e5)),
+]
+
+FINANCIAL_SUMMARY = [
+    ('Revenue',                 (1e3, 1e6)),
+    ('Gross Profit Margin %',   (5, 80)),
+    ('Operating Margin %',      (-10, 40)),
+    ('Net Profit Margin %',     (-10, 30)),
+    ('EBITDA',                  (1e3, 3e5)),
+]
+
+GROWTH = [
+    ('Revenue %',               (-20, 50)),
+    ('Operating Income %',      (-30, 60)),
+    ('EPS %',                   (-40, 80)),
+]
+
+PROFITABILITY_AND_EFFICIENCY = [
+    ('Return on Assets %',      (-5, 30)),
+    ('Return on Equity %',      (-10, 60)),
+    ('Return on Invested Capital %', (-5, 40)),
+    ('Days Sales Outstanding',  (10, 90)),
+    ('Days Inventory',          (10, 120)),
+    ('Payables Period',         (10, 90)),
+    ('Cash Conversion Cycle',   (-30, 120)),
+    ('Receivable Turnover',     (2, 20)),
+    ('Inventory Turnover',      (2, 20)),
+    ('Asset Turnover',          (0.2, 2)),
+]
+
+FINANCIAL_HEALTH = [
+    ('Current Ratio',           (0.5, 5)),
+    ('Quick Ratio',             (0.3, 4)),
+    ('Debt/Equity',             (0, 3)),
+    ('Financial Leverage',      (1, 5)),
+]
+
+CASH_FLOW_METRICS = [
+    ('Operating Cash Flow Growth % YOY',    (-50, 80)),
+    ('Free Cash Flow Growth % YOY',         (-50, 80)),
+    ('Cap Ex as a % of Sales',              (0, 20)),
+]
+
+# 表名后缀 -> (行, 年份列格式, 年份之后的列)
+TABLES = {
+    'income_statement_annual_as_originally_reported':   (INCOME_STATEMENT,              '{}',       ['TTM']),
+    'balance_sheet_annual_as_originally_reported':      (BALANCE_SHEET,                 '{}',       []),
+    'cash_flow_annual_as_originally_reported':          (CASH_FLOW,                     '{}',       ['TTM']),
+    'financial_summary':                                (FINANCIAL_SUMMARY,             '{}',       ['Latest Qtr']),
+    'growth':                                           (GROWTH,                        '{}',       ['Latest Qtr']),
+    'profitability_and_efficiency':                     (PROFITABILITY_AND_EFFICIENCY,  '{}',       ['5-Yr', 'Latest Qtr']),
+    'financial_health':                                 (FINANCIAL_HEALTH,              '{}-12',    ['Latest Qtr']),
+    'cash_flow':                                        (CASH_FLOW_METRICS,             '{}',       ['5-Yr']),
+}
+
+def ticker_names(count, prefix='T'):
+    '''
+    模拟股票代码，如 T0001
+    '''
+    width = max(4, len(str(count)))
+    return [f"{prefix}{i:0{width}d}" for i in range(1, count + 1)]
+
+def generate_table(rng, rows, columns, missing):
+    '''
+    生成一个表，数值按比例随机替换为 '-'
+    '''
+    low = np.array([r[1][0] for r in rows])
+    high = np.array([r[1][1] for r in rows])
+    values = rng.uniform(low[:, None], high[:, None], size=(len(rows), len(columns))).round(2)
+
+    data = values.astype(object)
+    data[rng.random(values.shape) < missing] = '-'
+
+    df = pd.DataFrame(data, columns=columns)
+    df.insert(0, 'Name', [r[0] for r in rows])
+    df['Last Updated'] = datetime.now()
+    return df
+
+def generate_database(database, tickers, exchange='xnas', first_year=2014, last_year=2023,
+                      missing=0.02, seed=0):
+    '''
+    生成模拟数据库
+
+    Args:
+        database: Path of database
+        tickers: List of ticker names
+        exchange: Exchange name
+        first_year: First year of data
+        last_year: Last year of data
+        missing: Ratio of '-' cells
+        seed: Random seed
+    Returns:
+        Number of tables written
+    '''
+    rng = np.random.default_rng(seed)
+    years = range(first_year, last_year + 1)
+    db = sqlite3.connect(database)
+    count = 0
+    try:
+        for ticker in tickers:
+            for suffix, (rows, year_format, extra) in TABLES.items():
+                columns = [year_format.format(year) for year in years] + extra
+                df = generate_table(rng, rows, columns, missing)
+                df.to_sql(f"{ticker}_{exchange}_{suffix}".lower(), db, if_exists='replace', index=False)
+                count += 1
+        db.commit()
+    finally:
+        db.close()
+
+    return count
+
+def main():
+    parser = OptionParser()
+
+    parser.add_option("-o", "--output",
+                action="store", dest="output", default='synthetic.db3',
+                help="Output database, default synthetic.db3")
+    parser.add_option("-n", "--tickers",
+                action="store", dest="tickers", type="int", default=100,
+                help="Number of tickers, default 100")
+    parser.add_option("-e", "--exchange",
+                action="store", dest="exchange", default='xnas',
+                help="Exchange name, default xnas")
+    parser.add_option("--first-year",
+                action="store", dest="first_year", type="int", default=2014,
+                help="First year of data, default 2014")
+    parser.add_option("--last-year",
+                action="store", dest="last_year", type="int", default=2023,
+                help="Last year of data, default 2023")
+    parser.add_option("--missing",
+                action="store", dest="missing", type="float", default=0.02,
+                help="Ratio of '-' cells, default 0.02")
+    parser.add_option("--seed",
+                action="store", dest="seed", type="int", default=0,
+                help="Random seed, default 0")
+
+    (opts, args) = parser.parse_args()
+
+    tickers = ticker_names(opts.tickers)
+    count = generate_database(opts.output, tickers, opts.exchange, opts.first_year, opts.last_year,
+                              opts.missing, opts.seed)
+    print(f"{count} tables of {len(tickers)} tickers written to {opts.output}")
+
+
+if __name__ == '__main__':
+    main()
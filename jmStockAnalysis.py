@@ -1,175 +1,1137 @@
 #!/usr/bin/python3 -u
+import os
+import re
+import sys
+import atexit
+import io
+import csv
+import time
 import sqlite3
-import pandas as pd
-import numpy as np
+import json
+import uuid
+import hashlib
+import glob
+import pathlib
+import functools
+import itertools
+import contextlib
+import collections
+import multiprocessing
+import importlib.util
+from math import inf
 from optparse import OptionParser
 
+def lazy_import(name):
+    '''
+    延迟导入模块，第一次访问其属性时才真正导入。
+    pandas 及 numpy 导入较慢，--help、参数错误或所有报告都未改变时无需导入
+
+    Args:
+        name: Module name
+    Returns:
+        Module, loaded on first attribute access
+    '''
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+class Profiler:
+    '''
+    按股票统计各阶段的耗时及调用次数。阶段可以嵌套，每个阶段只计入自身的耗时，
+    不包括嵌套在其中的其他阶段，如生成报告时按需读取数据的时间计入 read_sql
+    '''
+    def __init__(self):
+        # {(ticker, stage): [calls, seconds]}
+        self.records = {}
+        self.ticker = None
+        self._stack = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # 每层: [开始时间, 嵌套阶段的耗时]
+        frame = [time.perf_counter(), 0.0]
+        self._stack.append(frame)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - frame[0]
+            self._stack.pop()
+            if self._stack:
+                self._stack[-1][1] += elapsed
+            record = self.records.setdefault((self.ticker, name), [0, 0.0])
+            record[0] += 1
+            record[1] += elapsed - frame[1]
+
+    def merge(self, records):
+        '''
+        合并其他进程的统计记录
+        '''
+        for key, (calls, seconds) in records.items():
+            record = self.records.setdefault(key, [0, 0.0])
+            record[0] += calls
+            record[1] += seconds
+
+    def stages(self):
+        '''
+        Returns:
+            Dict of {stage: (calls, seconds)} of all tickers, slowest first
+        '''
+        totals = {}
+        for (_, name), (calls, seconds) in self.records.items():
+            total = totals.setdefault(name, [0, 0.0])
+            total[0] += calls
+            total[1] += seconds
+        return {name: tuple(v) for name, v in sorted(totals.items(), key=lambda kv: -kv[1][1])}
+
+    def slowest(self, n=10):
+        '''
+        Returns:
+            List of (ticker, seconds, slowest stage), at most n, slowest first
+        '''
+        tickers = {}
+        for (ticker, name), (_, seconds) in self.records.items():
+            tickers.setdefault(ticker, {})[name] = seconds
+        rows = [(ticker, sum(stages.values()), max(stages, key=stages.get))
+                for ticker, stages in tickers.items() if ticker is not None]
+        return sorted(rows, key=lambda row: -row[1])[:n]
+
+    def write(self, path):
+        '''
+        保存每个股票每个阶段的统计，扩展名为 .csv 时输出 csv，否则输出 json
+        '''
+        rows = [(ticker, name, calls, seconds)
+                for (ticker, name), (calls, seconds) in sorted(self.records.items(), key=lambda kv: (str(kv[0][0]), kv[0][1]))]
+        with open(path, 'w', newline='') as file:
+            if path.endswith('.csv'):
+                writer = csv.writer(file)
+                writer.writerow(['ticker', 'stage', 'calls', 'seconds'])
+                writer.writerows(rows)
+            else:
+                json.dump({
+                    'stages': {name: dict(calls=calls, seconds=seconds)
+                               for name, (calls, seconds) in self.stages().items()},
+                    'tickers': [dict(ticker=ticker, stage=name, calls=calls, seconds=seconds)
+                                for ticker, name, calls, seconds in rows],
+                }, file, indent=2)
+
+    def print_summary(self, file=sys.stderr, top=10):
+        print(f"{'stage':<14}{'calls':>8}{'seconds':>10}", file=file)
+        for name, (calls, seconds) in self.stages().items():
+            print(f"{name:<14}{calls:>8}{seconds:>10.3f}", file=file)
+        slowest = self.slowest(top)
+        if slowest:
+            print(f"Top {len(slowest)} slowest tickers:", file=file)
+            for ticker, seconds, name in slowest:
+                print(f"{ticker:<14}{seconds:>10.3f}  {name}", file=file)
+
+# 当前进程的 Profiler，None 时不统计
+_profiler = None
+_not_profiled = contextlib.nullcontext()
+
+def set_profiler(profiler):
+    '''
+    启用或关闭 (None) 耗时统计
+
+    Returns:
+        Previous Profiler or None
+    '''
+    global _profiler
+    previous, _profiler = _profiler, profiler
+    return previous
+
+def profile(stage):
+    '''
+    统计一个阶段的耗时: with profile('read_sql'): ...
+    未启用时返回一个空的 context manager，开销可忽略
+    '''
+    if _profiler is None:
+        return _not_profiled
+    return _profiler.stage(stage)
+
+def profile_ticker(ticker):
+    '''
+    之后的耗时计入该股票
+    '''
+    if _profiler is not None:
+        _profiler.ticker = ticker
+
+def profiled_call(func, task):
+    '''
+    在工作进程中统计单个任务的耗时
+
+    Returns:
+        (Return value of func(task), Profiler.records of the task)
+    '''
+    profiler = Profiler()
+    previous = set_profiler(profiler)
+    try:
+        return func(task), profiler.records
+    finally:
+        set_profiler(previous)
+
+# 只读连接的 pragma: 用 mmap 直接读取数据库文件，加大页缓存 (负数单位为 KiB)
+READ_PRAGMAS = {
+    'mmap_size':    256 * 1024 * 1024,
+    'cache_size':   -64 * 1024,
+}
+
+def open_readonly(database, immutable=False):
+    '''
+    以只读方式打开数据库
+
+    Args:
+        database: Path of database file
+        immutable: The database is not modified by any process while it is opened,
+                   sqlite skips file locking and change detection
+    Returns:
+        sqlite3.Connection
+    '''
+    uri = pathlib.Path(database).resolve().as_uri() + '?mode=ro'
+    if immutable:
+        uri += '&immutable=1'
+    db = sqlite3.connect(uri, uri=True)
+    for name, value in READ_PRAGMAS.items():
+        db.execute(f"PRAGMA {name} = {value}")
+    return db
+
+# 每个进程内按数据库文件缓存的只读连接，及是否以 immutable 方式打开
+_connections = {}
+_immutable = False
+
+def connection(database):
+    '''
+    本进程中该数据库的只读连接，第一次使用时打开
+    '''
+    if database not in _connections:
+        _connections[database] = open_readonly(database, _immutable)
+    return _connections[database]
+
+def close_connections():
+    for db in _connections.values():
+        db.close()
+    _connections.clear()
+
+@contextlib.contextmanager
+def connections(immutable=False):
+    '''
+    with 块中 connection() 复用已打开的只读连接，退出时全部关闭。
+    在 with 块中创建的工作进程继承 immutable 设置
+
+    Args:
+        immutable: Open databases as immutable, see open_readonly()
+    '''
+    global _immutable
+    previous, _immutable = _immutable, immutable
+    try:
+        yield connection
+    finally:
+        close_connections()
+        _immutable = previous
+
+class RawTable(collections.namedtuple('RawTable', ['columns', 'rows'])):
+    '''
+    原始数据表: 列名 list，及各行数据 2-D numpy.ndarray of object，不构造 DataFrame
+    '''
+    __slots__ = ()
+
+    def to_frame(self):
+        return pd.DataFrame(self.rows, columns=self.columns)
+
+def read_table(db, table_name):
+    '''
+    读取整个表，数据直接放入 numpy 数组
+
+    Args:
+        db: sqlite3.Connection
+        table_name: Table name
+    Returns:
+        RawTable
+    '''
+    with profile('read_sql'):
+        cursor = db.execute(f"SELECT * FROM '{table_name}'")
+        columns = [desc[0] for desc in cursor.description]
+        rows = np.empty((0, len(columns)), dtype=object)
+        fetched = cursor.fetchall()
+        if fetched:
+            rows = np.array(fetched, dtype=object)
+        return RawTable(columns, rows)
+
+# 可选的表名索引，由 --build-catalog 生成。存在时 resolve_tables() 按 ticker 查找，不扫描 sqlite_master
+CATALOG_TABLE = 'jm_table_catalog'
+
+def catalog_tables(db, ticker, prefix):
+    '''
+    从表名索引中查找股票的所有表
+
+    Args:
+        db: sqlite3.Connection
+        ticker: Stock ticker
+        prefix: Lower case prefix of table names
+    Returns:
+        Dict of {lower case name: table name}, or None if there is no catalog
+    '''
+    try:
+        rows = db.execute(f"SELECT name FROM {CATALOG_TABLE} WHERE ticker = ?", (ticker.lower(),)).fetchall()
+    except sqlite3.OperationalError:
+        return None
+    return {name.lower(): name for (name,) in rows if name.lower().startswith(prefix)}
+
+def build_catalog(database):
+    '''
+    生成表名索引，每个 msfinance 表一行 (ticker, exchange, name)，按 ticker 建立索引。
+    之后由 updateData.py 写入的表会自动加入索引
+
+    Args:
+        database: Path of database, opened for writing
+    Returns:
+        Number of tables indexed
+    '''
+    db = sqlite3.connect(database)
+    try:
+        rows = []
+        for (name,) in db.execute("SELECT name FROM sqlite_master WHERE type='table'"):
+            ticker, _, rest = name.lower().partition('_')
+            exchange, _, suffix = rest.partition('_')
+            if suffix and name != CATALOG_TABLE and not name.startswith('sqlite_'):
+                rows.append((ticker, exchange, name))
+
+        with db:
+            db.execute(f"DROP TABLE IF EXISTS {CATALOG_TABLE}")
+            db.execute(f"CREATE TABLE {CATALOG_TABLE} (ticker TEXT, exchange TEXT, name TEXT PRIMARY KEY)")
+            db.execute(f"CREATE INDEX {CATALOG_TABLE}_ticker ON {CATALOG_TABLE} (ticker)")
+            db.executemany(f"INSERT INTO {CATALOG_TABLE} VALUES (?, ?, ?)", rows)
+    finally:
+        db.close()
+
+    return len(rows)
+
+# msfinance 保存的表名为 '{ticker}_{exchange}_{suffix}'，全部小写
+# 三大财报优先使用原始报告 (As Originally Reported)，其次是重述报告 (Restated)
+TABLE_SUFFIXES = {
+    # 三大财报原始数据
+    'income_statement': (
+        'income_statement_annual_as_originally_reported',
+        'income_statement_annual_restated',
+    ),
+    'balance_sheet': (
+        'balance_sheet_annual_as_originally_reported',
+        'balance_sheet_annual_restated',
+    ),
+    'cash_flow': (
+        'cash_flow_annual_as_originally_reported',
+        'cash_flow_annual_restated',
+    ),
+
+    # 其他估值数据
+    'financial_summary': ('financial_summary',),
+    'growth': ('growth',),
+    'financial_health': ('financial_health',),
+    'profitability_and_efficiency': ('profitability_and_efficiency',),
+}
+
+# 分析中不使用，缺失时不报错
+OPTIONAL_TABLES = ('growth',)
+
+def resolve_tables(db, ticker, exchange=None):
+    '''
+    查找股票分析所需各表的准确表名，只查询一次表名索引或 sqlite_master。
+    未指定交易所时，从表名中识别交易所
+
+    Args:
+        db: sqlite3.Connection
+        ticker: Stock ticker
+        exchange: Exchange name, e.g. 'xnas', auto detected if None
+    Returns:
+        Dict of {statement: table name}
+    '''
+    prefix = f"{ticker}_".lower()
+    if exchange is not None:
+        prefix += f"{exchange}_".lower()
+
+    query = "SELECT name FROM sqlite_master WHERE type='table' AND substr(lower(name), 1, ?) = ?"
+    with profile('resolve'):
+        # 索引中没有的股票，可能是生成索引后才加入的，仍然扫描 sqlite_master
+        names = catalog_tables(db, ticker, prefix)
+        if not names:
+            names = {row[0].lower(): row[0] for row in db.execute(query, (len(prefix), prefix))}
+
+    # {exchange: {statement: table name}}
+    candidates = {}
+    for name in names:
+        rest = name[len(prefix):]
+        if exchange is None:
+            exch, _, rest = rest.partition('_')
+        else:
+            exch = exchange.lower()
+        candidates.setdefault(exch, {})
+        for statement, suffixes in TABLE_SUFFIXES.items():
+            if rest in suffixes:
+                found = candidates[exch].get(statement)
+                if found is None or suffixes.index(rest) < suffixes.index(found[0]):
+                    candidates[exch][statement] = (rest, names[name])
+
+    required = [s for s in TABLE_SUFFIXES if s not in OPTIONAL_TABLES]
+    complete = [exch for exch, tables in sorted(candidates.items())
+                if all(s in tables for s in required)]
+
+    if not complete:
+        raise ValueError(f"No complete financial data of {ticker} found in database")
+    if len(complete) > 1:
+        raise ValueError(f"{ticker} is found in exchanges {complete}, please specify one")
+
+    return {statement: name for statement, (_, name) in candidates[complete[0]].items()}
+
+# 各表的数据列: 去掉第一列表头，以及末尾的 TTM / Latest Qtr / Last Updated 等列
+VALUE_COLUMNS = {
+    'income_statement':             slice(1, -2),
+    'balance_sheet':                slice(1, -1),
+    'cash_flow':                    slice(1, -2),
+    'financial_summary':            slice(1, -2),
+    'profitability_and_efficiency': slice(1, -3),
+    'financial_health':             slice(1, -2),
+}
+
+# 数据列为 'YYYY-MM' 的表，需去掉月份
+MONTHLY_TABLES = ('financial_health',)
+
+# 财报科目: 属性名 -> (表, 表头)
+# 表头按顺序匹配，优先完全相同的行，其次是包含该表头的第一行；缩进用于区分科目层级
+LINE_ITEMS = {
+    # Income statement
+    'basic_eps':                    ('income_statement', ('Basic EPS',)),
+
+    # Balance sheet
+    'total_assets':                 ('balance_sheet', ('Total Assets',)),
+    'current_liabilities':          ('balance_sheet', ('    Total Current Liabilities',)),
+    'inventories':                  ('balance_sheet', ('        Inventories',)),
+    'cash_and_cash_equivalents':    ('balance_sheet', ('            Cash and Cash Equivalents',)),
+    'total_liabilities':            ('balance_sheet', ('Total Liabilities',)),
+    'total_equity':                 ('balance_sheet', ('Total Equity',)),
+    'total_noncurrent_liabilities': ('balance_sheet', ('    Total Non-Current Liabilities',)),
+    'total_noncurrent_assets':      ('balance_sheet', ('    Total Non-Current Assets',)),
+    'net_ppe':                      ('balance_sheet', ('        Net Property, Plant and Equipment',)),
+    'total_long_term_investments':  ('balance_sheet', ('        Total Long Term Investments',)),
+
+    # Cash flow
+    'operating_cash_flow':          ('cash_flow', ('Cash Flow from Operating Activities, Indirect',)),
+    'investing_cash_flow':          ('cash_flow', ('Cash Flow from Investing Activities',)),
+    'capital_expenditures':         ('cash_flow', ('        Purchase/Sale and Disposal of Property, Plant and Equipment, Net',)),
+    'st_debt_repayments':           ('cash_flow', ('                Repayments for Short Term Debt',)),
+    'lt_debt_repayments':           ('cash_flow', ('                Repayments for Long Term Debt',)),
+    'dividends_paid':               ('cash_flow', ('        Cash Dividends and Interest Paid',
+                                                   '        Cash Dividends Paid to Non-Controlling/Minority Interests')),
+
+    # Financial summary
+    'gross_margin':                 ('financial_summary', ('Gross Profit Margin %',)),
+    'operating_margin':             ('financial_summary', ('Operating Margin %',)),
+    'net_margin':                   ('financial_summary', ('Net Profit Margin %',)),
+
+    # Profitability and efficiency
+    'days_sales_outstanding':       ('profitability_and_efficiency', ('Days Sales Outstanding',)),
+    'days_inventory_outstanding':   ('profitability_and_efficiency', ('Days Inventory',)),
+    'days_payables_outstanding':    ('profitability_and_efficiency', ('Payables Period',)),
+    'asset_turnover':               ('profitability_and_efficiency', ('Asset Turnover',)),
+    'return_on_equity':             ('profitability_and_efficiency', ('Return on Equity %',)),
+
+    # Financial health
+    'current_ratio':                ('financial_health', ('Current Ratio',)),
+    'quick_ratio':                  ('financial_health', ('Quick Ratio',)),
+}
+
+# 部分公司没有的科目，缺失时按 0 处理，其他缺失科目为 NaN
+ZERO_IF_MISSING = ('inventories', 'total_long_term_investments', 'dividends_paid')
+
+def find_header(headers, index, patterns):
+    '''
+    在表头中查找科目所在的行
+
+    Args:
+        headers: Row headers, list of str
+        index: Dict of {header: first row position}
+        patterns: Candidate headers, in priority order
+    Returns:
+        Row position, or None if not found
+    '''
+    for pattern in patterns:
+        if pattern in index:
+            return index[pattern]
+
+    for pattern in patterns:
+        for pos, header in enumerate(headers):
+            if pattern in header:
+                return pos
+
+    return None
+
+def extract_line_items(tables):
+    '''
+    按 LINE_ITEMS 提取财报科目，每个表只建立一次表头索引，
+    一次取出所需的所有行，并统一转换为 float64，'-' 视为 0
+
+    Args:
+        tables: Dict of {statement: RawTable}, only line items of these statements are extracted
+    Returns:
+        Dict of {line item: pandas.Series}, indexed by year
+    '''
+    with profile('extract'):
+        return _extract_line_items(tables)
+
+def _extract_line_items(tables):
+    items = {}
+    for statement, raw in tables.items():
+        if statement not in VALUE_COLUMNS:
+            continue
+        columns = VALUE_COLUMNS[statement]
+        headers = [str(header) for header in raw.rows[:, 0]]
+        index = {}
+        for pos, header in enumerate(headers):
+            index.setdefault(header, pos)
+
+        years = raw.columns[columns]
+        if statement in MONTHLY_TABLES:
+            # Trim month in index, 'YYYY-MM'
+            years = [re.sub(r'-..', '', year) for year in years]
+        years = pd.Index(years, dtype=object)
+
+        names, positions = [], []
+        for name, (table, patterns) in LINE_ITEMS.items():
+            if table != statement:
+                continue
+            pos = find_header(headers, index, patterns)
+            if pos is None:
+                fill = 0.0 if name in ZERO_IF_MISSING else np.nan
+                items[name] = pd.Series(fill, index=years)
+            else:
+                names.append(name)
+                positions.append(pos)
+
+        values = raw.rows[positions, columns]
+        values[values == '-'] = 0
+        values = values.astype(np.float64)
+        for name, row in zip(names, values):
+            items[name] = pd.Series(row, index=years)
+
+    return items
+
+# 修改 LINE_ITEMS 或提取方式时需增加版本号，使旧缓存失效
+CACHE_VERSION = 1
+
+# 修改指标计算、分析规则或报告样式时需增加版本号，使所有报告重新生成
+REPORT_VERSION = 1
+
+def db_stamp(database):
+    '''
+    数据库文件的大小及修改时间，用于快速判断数据库是否有更新
+
+    Returns:
+        (size, mtime in ns)
+    '''
+    st = os.stat(database)
+    return st.st_size, st.st_mtime_ns
+
+def raw_fingerprint(tables, raw):
+    '''
+    由已读取的原始数据表计算指纹: 表名、表头列及 VALUE_COLUMNS 中的数据列。
+    TTM / Latest Qtr / Last Updated 等未使用的列不计入，msfinance 更新后数值未变时指纹不变
+
+    Args:
+        tables: Dict of {statement: table name}
+        raw: Dict of {statement: RawTable}, statements in VALUE_COLUMNS
+    Returns:
+        Fingerprint, hex str
+    '''
+    with profile('fingerprint'):
+        digest = hashlib.sha1(f"v{CACHE_VERSION}".encode())
+        for statement in sorted(raw):
+            table = raw[statement]
+            columns = VALUE_COLUMNS[statement]
+            content = (table.columns[0], table.columns[columns], table.rows[:, 0].tolist(),
+                       table.rows[:, columns].tolist())
+            digest.update(f"{statement}:{tables[statement]}:{content!r}".encode())
+        return digest.hexdigest()
+
+class FundamentalsCache:
+    '''
+    已提取财报科目的磁盘缓存，保存在数据库旁的 '<database>.cache' 目录中，每个股票一个 npz 文件。
+
+    缓存以原始表的指纹为键。数据库文件的大小及修改时间未变时直接使用缓存，不访问数据库；
+    否则由调用者读取原始表并计算指纹，指纹不同时缓存失效。
+    CACHE_VERSION 或 LINE_ITEMS 与缓存中记录的不同时，缓存总是失效
+    '''
+    def __init__(self, database, rebuild=False):
+        '''
+        Args:
+            database: Path of database
+            rebuild: Ignore existing cache files and write new ones
+        '''
+        self.database = database
+        self.directory = f"{database}.cache"
+        self.rebuild = rebuild
+
+    def path(self, ticker, exchange=None):
+        name = ticker if exchange is None else f"{ticker}_{exchange}"
+        return os.path.join(self.directory, f"{name.lower()}.npz")
+
+    def db_stamp(self):
+        return np.array(db_stamp(self.database), dtype=np.int64)
+
+    def load(self, ticker, exchange, fingerprint=None):
+        '''
+        读取缓存
+
+        Args:
+            ticker: Stock ticker
+            exchange: Exchange name, or None
+            fingerprint: Fingerprint of the raw tables, see raw_fingerprint(), only needed if database has changed
+        Returns:
+            (tables, items, fingerprint) as from load_line_items(), or None if cache missed
+        '''
+        path = self.path(ticker, exchange)
+        if self.rebuild or not os.path.exists(path):
+            return None
+
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                data = dict(data)
+        except (OSError, ValueError):
+            return None
+
+        # 提取方式或科目已改变的旧缓存，数据库未更新时也不可使用
+        if 'version' not in data or int(data['version']) != CACHE_VERSION \
+                or set(data['items'].tolist()) != set(LINE_ITEMS):
+            return None
+
+        tables = dict(zip(data['statements'].tolist(), data['tables'].tolist()))
+        stamp = self.db_stamp()
+        if not np.array_equal(stamp, data['stamp']):
+            # 数据库有更新，检查该股票的数据是否改变
+            if fingerprint != str(data['fingerprint']):
+                return None
+            data['stamp'] = stamp
+            self._save(path, data)
+
+        items = {}
+        for name in data['items'].tolist():
+            items[name] = pd.Series(data[f"{name}.values"], index=pd.Index(data[f"{name}.index"], dtype=object))
+        return tables, items, str(data['fingerprint'])
+
+    def store(self, ticker, exchange, tables, items, fingerprint):
+        '''
+        保存已提取的财报科目
+
+        Args:
+            ticker: Stock ticker
+            exchange: Exchange name, or None
+            tables: Dict of {statement: table name}
+            items: Dict of {line item: pandas.Series}
+            fingerprint: Fingerprint of the raw tables the items are extracted from
+        '''
+        data = {
+            'version': np.array(CACHE_VERSION),
+            'fingerprint': np.array(fingerprint),
+            'stamp': self.db_stamp(),
+            'statements': np.array(list(tables.keys())),
+            'tables': np.array(list(tables.values())),
+            'items': np.array(list(items.keys())),
+        }
+        for name, series in items.items():
+            data[f"{name}.index"] = np.array(series.index.astype(str).tolist(), dtype=str)
+            data[f"{name}.values"] = series.to_numpy(dtype=np.float64)
+
+        self._save(self.path(ticker, exchange), data)
+
+    def _save(self, path, data):
+        # 缓存不可写时（如只读目录）直接跳过
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, 'wb') as file:
+                np.savez(file, **data)
+            os.replace(tmp, path)
+        except OSError:
+            pass
+
+# 规范化的长表数据库 (store): 所有股票的财报科目保存在一个表中，每个数值一行，
+# 由 --import-store 从 msfinance 数据库导入，AnalysisBase 可直接读取
+STORE_TABLE = 'fundamentals'
+STORE_TICKERS = 'store_tickers'
+STORE_INFO = 'store_info'
+
+STORE_SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS {STORE_TABLE} (
+    ticker TEXT, exchange TEXT, statement TEXT, line_item TEXT, period TEXT, value REAL
+);
+CREATE INDEX IF NOT EXISTS {STORE_TABLE}_item_period ON {STORE_TABLE} (line_item, period);
+CREATE INDEX IF NOT EXISTS {STORE_TABLE}_ticker ON {STORE_TABLE} (ticker);
+CREATE TABLE IF NOT EXISTS {STORE_TICKERS} (
+    ticker TEXT, exchange TEXT, fingerprint TEXT, source TEXT, PRIMARY KEY (ticker, exchange)
+);
+CREATE TABLE IF NOT EXISTS {STORE_INFO} (key TEXT PRIMARY KEY, value TEXT);
+'''
+
+def is_store(db):
+    query = "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?"
+    return db.execute(query, (STORE_TABLE,)).fetchone() is not None
+
+def store_exchange(db, ticker, exchange=None):
+    '''
+    股票在 store 中的交易所及原始数据指纹
+
+    Args:
+        db: sqlite3.Connection of store
+        ticker: Stock ticker
+        exchange: Exchange name, auto detected if None
+    Returns:
+        (exchange, fingerprint)
+    '''
+    version = db.execute(f"SELECT value FROM {STORE_INFO} WHERE key = 'version'").fetchone()
+    if version is None or int(version[0]) != CACHE_VERSION:
+        raise ValueError("Store is imported by another version, please import again")
+
+    query = f"SELECT exchange, fingerprint FROM {STORE_TICKERS} WHERE ticker = ?"
+    rows = db.execute(query, (ticker.upper(),)).fetchall()
+    if exchange is not None:
+        rows = [row for row in rows if row[0] == exchange.lower()]
+
+    if not rows:
+        raise ValueError(f"No financial data of {ticker} found in store")
+    if len(rows) > 1:
+        raise ValueError(f"{ticker} is found in exchanges {sorted(row[0] for row in rows)}, please specify one")
+    return rows[0]
+
+def load_store_items(db, ticker, exchange=None):
+    '''
+    从 store 读取单一股票的财报科目，与 extract_line_items() 的结果相同
+
+    Returns:
+        Dict of {line item: pandas.Series}, indexed by year
+    '''
+    with profile('read_sql'):
+        exchange, _ = store_exchange(db, ticker, exchange)
+        query = f"SELECT line_item, period, value FROM {STORE_TABLE} WHERE ticker = ? AND exchange = ? ORDER BY rowid"
+        rows = db.execute(query, (ticker.upper(), exchange)).fetchall()
+
+    grouped = {}
+    for name, period, value in rows:
+        periods, values = grouped.setdefault(name, ([], []))
+        periods.append(period)
+        values.append(value)
+
+    # NULL 为 NaN
+    empty = ([], [])
+    return {name: pd.Series(np.array(grouped.get(name, empty)[1], dtype=np.float64),
+                            index=pd.Index(grouped.get(name, empty)[0], dtype=object))
+            for name in LINE_ITEMS}
+
+def import_store(store, databases):
+    '''
+    将 msfinance 数据库中所有股票的财报科目导入 store。已导入的股票被替换，
+    原始数据未改变的股票跳过
+
+    Args:
+        store: Path of store, created if not exist
+        databases: List of path of msfinance databases
+    Returns:
+        (Number of imported tickers, number of unchanged tickers, list of (ticker, database, error message))
+    '''
+    imported, unchanged, failures = 0, 0, []
+    out = sqlite3.connect(store)
+    try:
+        out.executescript(STORE_SCHEMA)
+        with out:
+            version = out.execute(f"SELECT value FROM {STORE_INFO} WHERE key = 'version'").fetchone()
+            if version is not None and int(version[0]) != CACHE_VERSION:
+                # 提取方式已改变，全部重新导入
+                out.execute(f"DELETE FROM {STORE_TABLE}")
+                out.execute(f"DELETE FROM {STORE_TICKERS}")
+            out.execute(f"INSERT OR REPLACE INTO {STORE_INFO} VALUES ('version', ?)", (str(CACHE_VERSION),))
+
+        fingerprints = {(ticker, exchange): fingerprint for ticker, exchange, fingerprint
+                        in out.execute(f"SELECT ticker, exchange, fingerprint FROM {STORE_TICKERS}")}
+
+        for database in databases:
+            with contextlib.closing(open_readonly(database)) as db:
+                for ticker, exchange in list_tickers(db):
+                    try:
+                        tables = resolve_tables(db, ticker, exchange)
+                        raw = {statement: read_table(db, table_name) for statement, table_name in tables.items()
+                               if statement in VALUE_COLUMNS}
+                        fingerprint = raw_fingerprint(tables, raw)
+                        if fingerprints.get((ticker, exchange)) == fingerprint:
+                            unchanged += 1
+                            continue
+                        items = extract_line_items(raw)
+                    except Exception as e:
+                        failures.append((ticker, database, f"{type(e).__name__}: {e}"))
+                        continue
+
+                    rows = [(ticker, exchange, LINE_ITEMS[name][0], name, period, None if np.isnan(value) else value)
+                            for name, series in items.items()
+                            for period, value in zip(series.index, series.to_numpy().tolist())]
+                    with out:
+                        out.execute(f"DELETE FROM {STORE_TABLE} WHERE ticker = ? AND exchange = ?", (ticker, exchange))
+                        out.executemany(f"INSERT INTO {STORE_TABLE} VALUES (?, ?, ?, ?, ?, ?)", rows)
+                        out.execute(f"INSERT OR REPLACE INTO {STORE_TICKERS} VALUES (?, ?, ?, ?)",
+                                    (ticker, exchange, fingerprint, database))
+                    fingerprints[(ticker, exchange)] = fingerprint
+                    imported += 1
+        out.execute("ANALYZE")
+    finally:
+        out.close()
+
+    return imported, unchanged, failures
+
+def store_cross_section(db, line_items, period, exchange=None):
+    '''
+    所有股票某一年的财报科目，每个科目一次索引查询，
+    如所有港股 2023 年的资产负债率:
+        df = store_cross_section(db, ['total_liabilities', 'total_assets'], '2023', 'xhkg')
+        df['total_liabilities'] / df['total_assets']
+
+    Args:
+        db: sqlite3.Connection of store
+        line_items: List of line item names in LINE_ITEMS
+        period: Year, str
+        exchange: Exchange name, None for all exchanges
+    Returns:
+        pandas.DataFrame, (ticker, exchange) x line item
+    '''
+    query = f"SELECT ticker, exchange, value FROM {STORE_TABLE} WHERE line_item = ? AND period = ?"
+    params = ()
+    if exchange is not None:
+        query += " AND exchange = ?"
+        params = (exchange.lower(),)
+
+    columns = {}
+    for name in line_items:
+        rows = db.execute(query, (name, str(period)) + params).fetchall()
+        columns[name] = pd.Series([row[2] for row in rows], dtype=np.float64,
+                                  index=pd.MultiIndex.from_tuples([row[:2] for row in rows], names=['ticker', 'exchange']))
+    return pd.DataFrame(columns).sort_index()
+
+# AnalysisBase 中计算得到的指标: 属性名 -> 计算方法
+DERIVED_METRICS = {
+    'inventories_increase':                         'get_inventories_increase',
+    'cash_flow_ratio':                              'get_cash_flow_ratio',
+    'cash_flow_adequancy_ratio':                    'get_cash_flow_adequancy_ratio',
+    'cash_reinvestment_ratio':                      'get_cash_reinvestment_ratio',
+    'cash_to_total_assets_ratio':                   'get_cash_to_total_assets_ratio',
+    'cash_conversion_cycle':                        'get_cash_conversion_cycle',
+    'operating_cycle':                              'get_operating_cycle',
+    'operation_safety_margin':                      'get_operation_safety_margin',
+    'debt_ratio':                                   'get_debt_ratio',
+    'fixed_assets_to_long_term_liabilities_ratio':  'get_fixed_assets_to_long_term_liabilities_ratio',
+}
+
+# 报告中的指标: 属性名 -> 名称，按报告中的行顺序
+REPORT_METRICS = {
+    'cash_flow_ratio':                              '现金流动负债比率',
+    'cash_flow_adequancy_ratio':                    '现金流量允当比率',
+    'cash_reinvestment_ratio':                      '现金再投资比率',
+    'cash_to_total_assets_ratio':                   '现金占总资产比率',
+    'days_sales_outstanding':                       '平均收现天数',
+    'days_inventory_outstanding':                   '平均销货天数',
+    'days_payables_outstanding':                    '应付账款天数',
+    'cash_conversion_cycle':                        '现金转换周期',
+    'operating_cycle':                              '生意完整周期',
+    'asset_turnover':                               '资产周转率',
+    'gross_margin':                                 '营业毛利率',
+    'operating_margin':                             '营业利润率',
+    'operation_safety_margin':                      '营业安全边际率',
+    'net_margin':                                   '净利率',
+    'basic_eps':                                    '每股收益',
+    'return_on_equity':                             '股本回报率',
+    'debt_ratio':                                   '资产负债率',
+    'fixed_assets_to_long_term_liabilities_ratio':  '长期资产合适率',
+    'current_ratio':                                '流动比率',
+    'quick_ratio':                                  '速动比率',
+}
+
+def load_line_items(connect, ticker, exchange=None, cache=None):
+    '''
+    读取单一股票的原始数据并提取财报科目，缓存命中时不访问数据库。
+    数据库为 store 时直接读取已提取的科目。原始数据表只读取一次，指纹由读取的数据计算
+
+    Args:
+        connect: Callable returning sqlite3.Connection, called only if needed
+        ticker: Stock ticker
+        exchange: Exchange name, auto detected if None
+        cache: FundamentalsCache of the database, None to disable
+    Returns:
+        (tables, items, fingerprint): dict of {statement: table name},
+        dict of {line item: pandas.Series}, and fingerprint of the raw tables, see raw_fingerprint(),
+        or the fingerprint recorded in store
+    '''
+    if cache is not None:
+        with profile('cache'):
+            cached = cache.load(ticker, exchange)
+        if cached is not None:
+            return cached
+
+    db = connect()
+    if is_store(db):
+        _, fingerprint = store_exchange(db, ticker, exchange)
+        return {}, load_store_items(db, ticker, exchange), fingerprint
+
+    # 只读取提取科目所需的表，不读取 growth 等未使用的表
+    tables = resolve_tables(db, ticker, exchange)
+    raw = {statement: read_table(db, table_name) for statement, table_name in tables.items()
+           if statement in VALUE_COLUMNS}
+    fingerprint = raw_fingerprint(tables, raw)
+
+    if cache is not None:
+        # 数据库有更新但该股票的数据未改变时仍使用缓存
+        with profile('cache'):
+            cached = cache.load(ticker, exchange, fingerprint)
+        if cached is not None:
+            return cached
+
+    items = extract_line_items(raw)
+    if cache is not None:
+        with profile('cache'):
+            cache.store(ticker, exchange, tables, items, fingerprint)
+
+    return tables, items, fingerprint
+
+@functools.lru_cache(maxsize=256)
+def shared_years(years):
+    '''
+    年份相同的 MetricTable 共用一个年份索引
+
+    Args:
+        years: Tuple of years, sorted
+    Returns:
+        pandas.Index
+    '''
+    return pd.Index(years, dtype=object)
+
+class MetricTable:
+    '''
+    单一股票的财报科目及指标，保存为一个 (指标 x 年份) 的 float64 数组，所有指标共用一个年份索引。
+    present 记录各指标有数据的年份，其他单元格为 NaN，取出的 pandas.Series 与保存时的索引相同
+    '''
+    __slots__ = ('years', 'values', 'present', 'stored')
+
+    # 可保存的科目及指标的行号，所有实例共用
+    ROWS = {name: row for row, name in enumerate(dict.fromkeys([*LINE_ITEMS, *DERIVED_METRICS, *REPORT_METRICS]))}
+
+    def __init__(self):
+        self.years = shared_years(())
+        self.values = np.empty((len(self.ROWS), 0))
+        self.present = np.empty((len(self.ROWS), 0), dtype=bool)
+        self.stored = np.zeros(len(self.ROWS), dtype=bool)
+
+    def __contains__(self, name):
+        row = self.ROWS.get(name)
+        return row is not None and self.stored[row]
+
+    def set(self, name, series):
+        '''
+        保存一个指标，年份不在索引中时扩展索引
+
+        Args:
+            name: Name in ROWS
+            series: pandas.Series indexed by year
+        '''
+        self.update({name: series})
+
+    def update(self, items):
+        '''
+        一次保存多个指标，索引只扩展一次
+
+        Args:
+            items: Dict of {name in ROWS: pandas.Series indexed by year}
+        '''
+        years = set()
+        for series in items.values():
+            if not series.index.equals(self.years):
+                years.update(series.index)
+        if not years.issubset(self.years):
+            years = shared_years(tuple(sorted(years.union(self.years))))
+            cols = years.get_indexer(self.years)
+            values = np.full((len(self.ROWS), len(years)), np.nan)
+            present = np.zeros(values.shape, dtype=bool)
+            values[:, cols] = self.values
+            present[:, cols] = self.present
+            self.years, self.values, self.present = years, values, present
+
+        for name, series in items.items():
+            row = self.ROWS[name]
+            if series.index.equals(self.years):
+                self.values[row] = series.to_numpy(dtype=np.float64)
+                self.present[row] = True
+            else:
+                cols = self.years.get_indexer(series.index)
+                self.values[row] = np.nan
+                self.values[row, cols] = series.to_numpy(dtype=np.float64)
+                self.present[row] = False
+                self.present[row, cols] = True
+            self.stored[row] = True
+
+    def get(self, name):
+        '''
+        取出一个指标，所有年份都有数据时为数组的视图
+
+        Returns:
+            pandas.Series indexed by year
+        '''
+        row = self.ROWS[name]
+        present = self.present[row]
+        if present.all():
+            return pd.Series(self.values[row], index=self.years, copy=False)
+        return pd.Series(self.values[row, present], index=self.years[present])
+
+    def frame(self, names):
+        '''
+        多个指标组成的表，年份为其中任一指标有数据的年份，与 pandas.concat() 对齐的结果相同
+
+        Args:
+            names: List of names in ROWS
+        Returns:
+            pandas.DataFrame, (name x year)
+        '''
+        rows = [self.ROWS[name] for name in names]
+        cols = self.present[rows].any(axis=0)
+        return pd.DataFrame(self.values[rows][:, cols], index=names, columns=self.years[cols])
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.present.nbytes + self.stored.nbytes
+
 class AnalysisBase:
     '''
-    对单一股票的分析基类，获取原始数据，计算各种指标
-    '''
-    def __init__(self, database, ticker, exchange=None):
-        self.db = sqlite3.connect(database)
-
-        query = f"SELECT name FROM sqlite_master WHERE type='table' AND name LIKE '{ticker}%'"
-        tables = pd.read_sql_query(query, self.db)
-
-        for table_name in tables['name']:
-            query = f"SELECT * FROM '{table_name}'"
-
-            # 保存三大财报原始数据，DataFrame
-            if 'income_statement_' in table_name:
-                self.income_statement = pd.read_sql_query(query, self.db)
-            elif 'balance_sheet_' in table_name:
-                self.balance_sheet = pd.read_sql_query(query, self.db)
-            elif 'cash_flow_' in table_name:
-                self.cash_flow = pd.read_sql_query(query, self.db)
-
-            # 其他估值数据
-            elif '_financial_summary' in table_name:
-                self.financial_summary = pd.read_sql_query(query, self.db)
-            elif '_growth' in table_name:
-                self.growth = pd.read_sql_query(query, self.db)
-            elif '_financial_health' in table_name:
-                self.financial_health = pd.read_sql_query(query, self.db)
-            elif '_profitability_and_efficiency' in table_name:
-                self.profitability_and_efficiency = pd.read_sql_query(query, self.db)
-
-        # 提取财报原始数据
-        # Income statement
-        for i in range(self.income_statement.shape[0]):
-            header = self.income_statement.loc[i][0]
-            if ('Basic EPS' in header):
-                self.basic_eps = self.income_statement.loc[i][1:-2].replace('-', 0)
-
-        # Balance sheet 
-        for i in range(self.balance_sheet.shape[0]):
-            header = self.balance_sheet.loc[i][0]
-            if ('Total Assets' in header):
-                self.total_assets = self.balance_sheet.loc[i][1:-1]
-            elif ('    Total Current Liabilities' in header):
-                self.current_liabilities = self.balance_sheet.loc[i][1:-1]
-            elif ('        Inventories' in header):
-                self.inventories = self.balance_sheet.loc[i][1:-1]
-                self.inventories_increase = self.inventories[-1] - self.inventories[-5]
-            elif ('            Cash and Cash Equivalents' in header):
-                self.cash_and_cash_equivalents = self.balance_sheet.loc[i][1:-1]
-            elif ('Total Liabilities' in header):
-                self.total_liabilities = self.balance_sheet.loc[i][1:-1]
-            elif ('Total Equity' in header):
-                self.total_equity = self.balance_sheet.loc[i][1:-1]
-            elif ('    Total Non-Current Liabilities' in header):
-                self.total_noncurrent_liabilities = self.balance_sheet.loc[i][1:-1]
-            elif ('    Total Non-Current Assets' in header):
-                self.total_noncurrent_assets = self.balance_sheet.loc[i][1:-1]
-            elif ('        Net Property, Plant and Equipment' in header):
-                self.net_ppe = self.balance_sheet.loc[i][1:-1]
-            elif ('        Total Long Term Investments' in header):
-                self.total_long_term_investments = self.balance_sheet.loc[i][1:-1]
-
-        # Assign to zero if item not found in balance sheet
-        if not hasattr(self, 'total_long_term_investments'):
-            self.total_long_term_investments = \
-                pd.Series(0, index=self.balance_sheet.loc[0][1:-1].index)
-
-        if not hasattr(self, 'inventories'):
-                self.inventories = pd.Series(0, index=self.balance_sheet.loc[0][1:-1].index)
-                self.inventories_increase = self.inventories[-1] - self.inventories[-5]
-
-        # Cash flow 
-        for i in range(self.cash_flow.shape[0]):
-            header = self.cash_flow.loc[i][0]
-            if ('Cash Flow from Operating Activities, Indirect' in header):
-                self.operating_cash_flow = self.cash_flow.loc[i][1:-2]
-            elif ('Cash Flow from Investing Activities' in header):
-                self.investing_cash_flow = self.cash_flow.loc[i][1:-2]
-            elif ('        Purchase/Sale and Disposal of Property, Plant and Equipment, Net' in header):
-                self.capital_expenditures = self.cash_flow.loc[i][1:-2]
-            elif ('                Repayments for Short Term Debt' in header):
-                self.st_debt_repayments = self.cash_flow.loc[i][1:-2]
-            elif ('                Repayments for Long Term Debt' in header):
-                self.lt_debt_repayments = self.cash_flow.loc[i][1:-2]
-            elif ('        Cash Dividends and Interest Paid' in header): # Dividends paid case 1
-                self.dividends_paid = self.cash_flow.loc[i][1:-2]
-            elif ('        Cash Dividends Paid to Non-Controlling/Minority Interests' in header): # Dividends paid case 2
-                self.dividends_paid = self.cash_flow.loc[i][1:-2]
-        
-        ## Assign to zeros if item is not found in cash flow 
-        if not hasattr(self, 'dividends_paid'):
-            self.dividends_paid = pd.Series(0, index=self.cash_flow.loc[0][1:-2].index)
-
-        # Financial summary
-        for i in range(self.financial_summary.shape[0]):
-            header = self.financial_summary.loc[i][0]
-            if ('Gross Profit Margin %' in header):
-                s = self.financial_summary.loc[i][1:-2]
-                self.gross_margin = self.to_float64(s)
-            elif ('Operating Margin %' in header):
-                s = self.financial_summary.loc[i][1:-2]
-                self.operating_margin = self.to_float64(s)
-            elif ('Net Profit Margin %' in header):
-                s = self.financial_summary.loc[i][1:-2]
-                self.net_margin = self.to_float64(s)
-        
-        # Profitability and efficiency
-        for i in range(self.profitability_and_efficiency.shape[0]):
-            header = self.profitability_and_efficiency.loc[i][0]
-            if ('Days Sales Outstanding' in header):
-                s = self.profitability_and_efficiency.loc[i][1:-3]
-                self.days_sales_outstanding = self.to_float64(s)
-            elif ('Days Inventory' in header):
-                s = self.profitability_and_efficiency.loc[i][1:-3]
-                self.days_inventory_outstanding = self.to_float64(s)
-            elif ('Payables Period' in header):
-                s = self.profitability_and_efficiency.loc[i][1:-3].replace('-', 0)
-                self.days_payables_outstanding = self.to_float64(s)
-            elif ('Asset Turnover' in header):
-                s = self.profitability_and_efficiency.loc[i][1:-3]
-                self.asset_turnover = self.to_float64(s)
-            elif ('Return on Equity %' in header):
-                s = self.profitability_and_efficiency.loc[i][1:-3]
-                self.return_on_equity = self.to_float64(s)
-
-        # Financial Health
-        for i in range(self.financial_health.shape[0]):
-            header = self.financial_health.loc[i][0]
-            if ('Current Ratio' in header):
-                s = self.financial_health.loc[i][1:-2]
-                self.current_ratio  = self.to_float64(s)
-                # Trim month in index, 'YYYY-MM' 
-                self.current_ratio.index = self.current_ratio.index.str.replace(r'-..', '', regex=True)
-            elif ('Quick Ratio' in header):
-                s = self.financial_health.loc[i][1:-2]
-                self.quick_ratio = self.to_float64(s)
-                # Trim month in index, 'YYYY-MM' 
-                self.quick_ratio.index = self.quick_ratio.index.str.replace(r'-..', '', regex=True)
-
-        # Initial all ratio
-        self.get_cash_flow_ratio()
-        self.get_cash_flow_adequancy_ratio()
-        self.get_cash_reinvestment_ratio()
-        self.get_cash_to_total_assets_ratio()
-        self.get_days_sales_outstanding()
-        self.get_days_inventory_outstanding()
-        self.get_days_payables_outstanding()
-        self.get_cash_conversion_cycle()
-        self.get_operating_cycle()
-        self.get_asset_turnover()
-        self.get_gross_margin()
-        self.get_operating_margin()
-        self.get_operation_safety_margin()
-        self.get_net_margin()
-        self.get_eps()
-        self.get_roe()
-        self.get_debt_ratio()
-        self.get_fixed_assets_to_long_term_liabilities_ratio()
-        self.get_current_ratio()
-        self.get_quick_ratio()
-    
-    def to_float64(self, series):
-        series = series.replace('-', 0)
-        series = series.astype(np.float64)
-        return series
+    对单一股票的分析基类，获取原始数据，计算各种指标。
+    科目及指标保存在 MetricTable 中，以同名属性访问，赋值时也写入 MetricTable
+    '''
+    def __init__(self, database, ticker, exchange=None, cache=None):
+        '''
+        Args:
+            database: Path of database, or an opened sqlite3.Connection
+            ticker: Stock ticker
+            exchange: Exchange name, auto detected if None
+            cache: FundamentalsCache of the database, None to disable
+        '''
+        # 批量模式下复用已打开的数据库连接，由调用者关闭；否则在需要时以只读方式打开
+        if isinstance(database, sqlite3.Connection):
+            self.database = None
+            self.db = database
+        else:
+            self.database = database
+            self.db = None
+
+        self.ticker = ticker
+        self.exchange = exchange
+        self.cache = cache
+        self.metrics = MetricTable()
+
+    def __getattr__(self, name):
+        '''
+        原始数据、财报科目及指标都在第一次访问时才读取或计算，并保存为属性。
+        指标之间的依赖由 get_* 方法中访问的属性决定，只读取用到的表
+        '''
+        if name.startswith('_') or name in ('db', 'database', 'ticker', 'exchange', 'cache', 'metrics'):
+            raise AttributeError(name)
+
+        if name in self.metrics:
+            return self.metrics.get(name)
+
+        if name == 'tables':
+            self.tables = resolve_tables(self.connect(), self.ticker, self.exchange)
+        elif name == 'fingerprint':
+            if is_store(self.connect()):
+                _, self.fingerprint = store_exchange(self.connect(), self.ticker, self.exchange)
+            else:
+                self.load_all_line_items()
+        elif name in TABLE_SUFFIXES:
+            setattr(self, name, read_table(self.connect(), self.tables[name]))
+        elif name in LINE_ITEMS:
+            self.load_line_items(LINE_ITEMS[name][0])
+        elif name in DERIVED_METRICS:
+            getattr(self, DERIVED_METRICS[name])()
+        else:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+        if name in self.metrics:
+            return self.metrics.get(name)
+        # 未能读取或计算出该属性时须抛出 AttributeError，hasattr() 及 getattr() 的默认值才有效
+        if name not in self.__dict__:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        return self.__dict__[name]
+
+    def __setattr__(self, name, value):
+        if name in MetricTable.ROWS and isinstance(value, pd.Series):
+            self.metrics.set(name, value)
+        else:
+            object.__setattr__(self, name, value)
+
+    def load_line_items(self, statement):
+        '''
+        提取一个表中的财报科目。启用缓存或数据库为 store 时，第一次调用即读取所有科目，
+        缓存未命中则提取所有科目并写入缓存。
+        提取后不保留原始数据表，访问同名属性时再重新读取
+
+        Args:
+            statement: Statement name in VALUE_COLUMNS
+        '''
+        if self.cache is not None or is_store(self.connect()):
+            self.load_all_line_items()
+        else:
+            raw = self.__dict__.get(statement)
+            if raw is None:
+                raw = read_table(self.connect(), self.tables[statement])
+            self.metrics.update(extract_line_items({statement: raw}))
+
+    def load_all_line_items(self):
+        '''
+        读取所有财报科目及原始数据的指纹 (fingerprint 属性)，每个原始数据表只读取一次
+        '''
+        self.tables, items, self.fingerprint = load_line_items(self.connect, self.ticker, self.exchange, self.cache)
+        self.cache = None
+        self.metrics.update(items)
+
+    def connect(self):
+        '''
+        获取数据库连接，第一次调用时打开
+
+        Returns:
+            sqlite3.Connection
+        '''
+        if self.db is None:
+            self.db = open_readonly(self.database)
+        return self.db
+
+    def close(self):
+        '''
+        关闭自己打开的数据库连接，已读取的数据及指标仍可使用
+        '''
+        if self.database is not None and self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get_inventories_increase(self):
+        '''
+        近 5 年存货增加
+        Inventories Increase = Inventories of latest year - Inventories of 5th latest year
+        '''
+        self.inventories_increase = self.inventories.iloc[-1] - self.inventories.iloc[-5]
+        return self.inventories_increase
 
     def get_cash_flow_ratio(self):
         '''
@@ -197,8 +1159,10 @@ class AnalysisBase:
             = self.operating_cash_flow[-5:].sum() \
                 / (-self.capital_expenditures[-5:].sum() + self.inventories_increase - self.dividends_paid[-5:].sum())
 
-        self.cash_flow_adequancy_ratio = pd.Series(index=self.operating_cash_flow.index) 
-        self.cash_flow_adequancy_ratio[-1] = cash_flow_adequancy_ratio
+        # 先填好再赋值，属性保存在 MetricTable 中，对取出的 Series 赋值不一定写回
+        ratio = pd.Series(np.nan, index=self.operating_cash_flow.index)
+        ratio.iloc[-1] = cash_flow_adequancy_ratio
+        self.cash_flow_adequancy_ratio = ratio
         return self.cash_flow_adequancy_ratio
 
     def get_cash_reinvestment_ratio(self):
@@ -343,315 +1307,1514 @@ class AnalysisBase:
         Returns:
             Analysis report, pandas.DataFrame
         '''
-        self.report = pd.DataFrame()
-        self.report = pd.concat([self.report, self.cash_flow_ratio.rename('现金流动负债比率')], axis=1)
-        self.report = pd.concat([self.report, self.cash_flow_adequancy_ratio.rename('现金流量允当比率')], axis=1)
-        self.report = pd.concat([self.report, self.cash_reinvestment_ratio.rename('现金再投资比率')], axis=1)
-        self.report = pd.concat([self.report, self.cash_to_total_assets_ratio.rename('现金占总资产比率')], axis=1) 
-        self.report = pd.concat([self.report, self.days_sales_outstanding.rename('平均收现天数')], axis=1)
-        self.report = pd.concat([self.report, self.days_inventory_outstanding.rename('平均销货天数')], axis=1) 
-        self.report = pd.concat([self.report, self.days_payables_outstanding.rename('应付账款天数')], axis=1)
-        self.report = pd.concat([self.report, self.cash_conversion_cycle.rename('现金转换周期')], axis=1)
-        self.report = pd.concat([self.report, self.operating_cycle.rename('生意完整周期')], axis=1)
-        self.report = pd.concat([self.report, self.asset_turnover.rename('资产周转率')], axis=1)
-        self.report = pd.concat([self.report, self.gross_margin.rename('营业毛利率')], axis=1)
-        self.report = pd.concat([self.report, self.operating_margin.rename('营业利润率')], axis=1)
-        self.report = pd.concat([self.report, self.operation_safety_margin.rename('营业安全边际率')], axis=1)
-        self.report = pd.concat([self.report, self.net_margin.rename('净利率')], axis=1)
-        self.report = pd.concat([self.report, self.basic_eps.rename('每股收益')], axis=1)
-        self.report = pd.concat([self.report, self.return_on_equity.rename('股本回报率')], axis=1)
-        self.report = pd.concat([self.report, self.debt_ratio.rename('资产负债率')], axis=1)
-        self.report = pd.concat([self.report, self.fixed_assets_to_long_term_liabilities_ratio.rename('长期资产合适率')], axis=1)
-        self.report = pd.concat([self.report, self.current_ratio.rename('流动比率')], axis=1)
-        self.report = pd.concat([self.report, self.quick_ratio.rename('速动比率')], axis=1) 
-
-        self.report = self.report.sort_index()
-
-        # Turn to a row base table for manual review
-        self.report = self.report.transpose()
+        with profile('metrics'):
+            for attr in REPORT_METRICS:
+                getattr(self, attr)
+
+            # 行为指标，列为任一指标有数据的年份，按年份排序
+            self.report = self.metrics.frame(list(REPORT_METRICS))
+            self.report.index = list(REPORT_METRICS.values())
         return self.report
 
+# 不影响报告年份的科目: 未用于计算，或只用于近 5 年合计
+UNREPORTED_ITEMS = (
+    'inventories', 'capital_expenditures', 'investing_cash_flow',
+    'st_debt_repayments', 'lt_debt_repayments', 'total_noncurrent_assets',
+)
+
+def last_years(present, n):
+    '''
+    每一行中最近 n 个有数据的年份，及其中最早的一年
+
+    Args:
+        present: 2-D bool numpy.ndarray, (ticker x year)
+        n: Number of years
+    Returns:
+        (latest, nth): 2-D bool numpy.ndarray of the same shape as present,
+        latest is True at the latest n years with data (all years with data if fewer),
+        nth is True only at the n-th latest year with data, all False in rows with fewer than n years
+    '''
+    count = np.cumsum(present[:, ::-1], axis=1)[:, ::-1]
+    return present & (count <= n), present & (count == n)
+
+class RatioPanel:
+    '''
+    多个股票的指标面板，各科目按 (股票 x 年份) 对齐为二维数组，一次计算所有股票的所有指标。
+    每行以 (ticker, exchange) 区分，同一代码在不同交易所上市的股票各占一行。
+    单一股票的 report() 与 AnalysisBase.generate_report() 相同
+    '''
+    def __init__(self, items_by_ticker):
+        '''
+        Args:
+            items_by_ticker: Dict of {(ticker, exchange): {line item: pandas.Series}},
+                             items as from load_line_items()
+        '''
+        self.tickers = list(items_by_ticker)
+        self.rows = {key: i for i, key in enumerate(self.tickers)}
+        self.index = pd.MultiIndex.from_tuples(self.tickers, names=['ticker', 'exchange']) \
+            if self.tickers else pd.MultiIndex.from_arrays([[], []], names=['ticker', 'exchange'])
+        years = set()
+        for items in items_by_ticker.values():
+            for series in items.values():
+                years.update(series.index)
+        self.years = pd.Index(sorted(years), dtype=object)
+
+        # 科目数值，以及该科目在各年份是否有数据
+        columns = {year: i for i, year in enumerate(self.years)}
+        shape = (len(self.tickers), len(self.years))
+        self.items = {}
+        self.present = {}
+        for name in LINE_ITEMS:
+            values = np.full(shape, np.nan)
+            present = np.zeros(shape, dtype=bool)
+            for row, items in enumerate(items_by_ticker.values()):
+                series = items[name]
+                cols = [columns[year] for year in series.index]
+                values[row, cols] = series.to_numpy(dtype=np.float64)
+                present[row, cols] = True
+            self.items[name] = values
+            self.present[name] = present
+
+        self.report_years = np.zeros(shape, dtype=bool)
+        for name, present in self.present.items():
+            if name not in UNREPORTED_ITEMS:
+                self.report_years |= present
+
+        self.metrics = self.compute()
+
+    def compute(self):
+        '''
+        计算所有指标，公式同 AnalysisBase 的 get_* 方法
+
+        Args: None
+        Returns:
+            Dict of {metric: 2-D numpy.ndarray}, metric names as in REPORT_METRICS
+        '''
+        v = self.items
+        m = {}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            m['cash_flow_ratio'] = v['operating_cash_flow'] / v['current_liabilities']
+
+            # 近 5 年合计，结果在经营现金流最新的年份
+            # 先取出这 5 年的数值再求和，保证与逐个股票计算时的求和顺序相同
+            def last5_sum(name):
+                last5, _ = last_years(self.present[name], 5)
+                cols = np.argsort(~last5, axis=1, kind='stable')[:, :5]
+                values = np.take_along_axis(v[name], cols, axis=1)
+                selected = np.take_along_axis(last5, cols, axis=1)
+                return np.where(selected & ~np.isnan(values), values, 0).sum(axis=1)
+
+            # 第 n 新年份的数值
+            def nth_latest(name, n):
+                _, nth = last_years(self.present[name], n)
+                return np.where(nth.any(axis=1), np.where(nth, v[name], 0).sum(axis=1), np.nan)
+
+            _, latest = last_years(self.present['operating_cash_flow'], 1)
+            inventories_increase = nth_latest('inventories', 1) - nth_latest('inventories', 5)
+            adequancy = last5_sum('operating_cash_flow') \
+                / (-last5_sum('capital_expenditures') + inventories_increase - last5_sum('dividends_paid'))
+            m['cash_flow_adequancy_ratio'] = np.where(latest, adequancy[:, None], np.nan)
+
+            m['cash_reinvestment_ratio'] = (v['operating_cash_flow'] + v['dividends_paid']) \
+                / (v['total_assets'] - v['current_liabilities'])
+            m['cash_to_total_assets_ratio'] = v['cash_and_cash_equivalents'] / v['total_assets']
+            m['days_sales_outstanding'] = v['days_sales_outstanding']
+            m['days_inventory_outstanding'] = v['days_inventory_outstanding']
+            m['days_payables_outstanding'] = v['days_payables_outstanding']
+            m['cash_conversion_cycle'] = v['days_inventory_outstanding'] + v['days_sales_outstanding'] \
+                - v['days_payables_outstanding']
+            m['operating_cycle'] = v['days_inventory_outstanding'] + v['days_sales_outstanding']
+            m['asset_turnover'] = v['asset_turnover']
+            m['gross_margin'] = v['gross_margin']
+            m['operating_margin'] = v['operating_margin']
+            m['operation_safety_margin'] = v['operating_margin'] / v['gross_margin']
+            m['net_margin'] = v['net_margin']
+            m['basic_eps'] = v['basic_eps']
+            m['return_on_equity'] = v['return_on_equity']
+            m['debt_ratio'] = v['total_liabilities'] / v['total_assets']
+            m['fixed_assets_to_long_term_liabilities_ratio'] = \
+                (v['total_equity'] + v['total_noncurrent_liabilities']) \
+                / (v['net_ppe'] + v['total_long_term_investments'])
+            m['current_ratio'] = v['current_ratio']
+            m['quick_ratio'] = v['quick_ratio']
+
+        return m
+
+    def metric(self, name):
+        '''
+        某一指标所有股票的数据
+
+        Args:
+            name: Metric name in REPORT_METRICS
+        Returns:
+            pandas.DataFrame, ((ticker, exchange) x year)
+        '''
+        return pd.DataFrame(self.metrics[name], index=self.index, columns=self.years)
+
+    def trend(self, name, window=None, normalize=False):
+        '''
+        某一指标所有股票的趋势，一次计算，见 trend_slopes()
+
+        Args:
+            name: Metric name in REPORT_METRICS
+            window: Fit only the latest n years with data, None for all years
+            normalize: Slope relative to the absolute value of the mean of the fitted years
+        Returns:
+            Slopes, pandas.Series indexed by (ticker, exchange)
+        '''
+        x = self.years.astype(np.float64).to_numpy()
+        return pd.Series(trend_slopes(self.metrics[name], x, window, normalize), index=self.index, name=name)
+
+    def row(self, ticker, exchange=None):
+        '''
+        股票所在的行
+
+        Args:
+            ticker: Stock ticker
+            exchange: Exchange name, auto detected if None
+        Returns:
+            Row index
+        '''
+        if (ticker, exchange) in self.rows:
+            return self.rows[(ticker, exchange)]
+
+        rows = [(key[1], i) for key, i in self.rows.items()
+                if key[0] == ticker and (exchange is None or key[1] == exchange)]
+        if not rows:
+            raise KeyError(f"{ticker} is not in the panel")
+        if len(rows) > 1:
+            raise ValueError(f"{ticker} is found in exchanges {sorted(row[0] for row in rows)}, please specify one")
+        return rows[0][1]
+
+    def report(self, ticker, exchange=None):
+        '''
+        单一股票的财务分析报告
+
+        Args:
+            ticker: Stock ticker
+            exchange: Exchange name, auto detected if None
+        Returns:
+            Analysis report, pandas.DataFrame, same as AnalysisBase.generate_report()
+        '''
+        row = self.row(ticker, exchange)
+        cols = self.report_years[row]
+        data = np.stack([self.metrics[attr][row, cols] for attr in REPORT_METRICS])
+        return pd.DataFrame(data, index=list(REPORT_METRICS.values()), columns=self.years[cols])
+
+def load_panel(database, tickers=None, cache='on'):
+    '''
+    读取数据库中多个股票的财报科目，生成指标面板
+
+    Args:
+        database: Path of database
+        tickers: List of (ticker, exchange), None for all tickers in database
+        cache: Cache mode, one of CACHE_MODES
+    Returns:
+        (RatioPanel, list of (ticker, exchange, error message))
+    '''
+    items_by_ticker = {}
+    failures = []
+    with connections():
+        db = connection(database)
+        if tickers is None:
+            tickers = list_tickers(db)
+
+        for ticker, exchange in tickers:
+            try:
+                _, items, _ = load_line_items(lambda: db, ticker, exchange, make_cache(database, cache))
+                items_by_ticker[(ticker, exchange)] = items
+            except Exception as e:
+                failures.append((ticker, exchange, f"{type(e).__name__}: {e}"))
+
+    return RatioPanel(items_by_ticker), failures
+
+def load_group(path):
+    '''
+    读取股票分组: docs/ 中的页面按其中包含的报告，如 docs/CPU.md，
+    其他文件每行最后一个字段为股票代码，如 updateData.py 的股票列表，空行及 '#' 之后的注释会被忽略
+
+    Args:
+        path: Group file
+    Returns:
+        Set of tickers, upper case
+    '''
+    with open(path) as file:
+        text = file.read()
+
+    if path.endswith('.md'):
+        return {ticker.upper() for ticker in re.findall(r"include\s+reports/([\w.-]+)\.html", text)}
+
+    lines = (line.split('#', 1)[0].split() for line in text.splitlines())
+    return {fields[-1].upper() for fields in lines if fields}
+
+class PeerGroup:
+    '''
+    同业比较: 每个指标每年的数值在一组股票中的百分位 (0~100)，相同数值取平均排名。
+    建立时每个指标对所有年份一次排序，之后每个数值只需二分查找
+    '''
+    def __init__(self, panel):
+        '''
+        Args:
+            panel: RatioPanel of all tickers in the group
+        '''
+        self.panel = panel
+        self.years = {str(year): i for i, year in enumerate(panel.years)}
+        # {metric name: (year x ticker) sorted, NaN last}, {metric name: number of values of each year}
+        self.sorted = {}
+        self.counts = {}
+        for attr, name in REPORT_METRICS.items():
+            values = panel.metrics[attr].T
+            self.sorted[name] = np.sort(values, axis=1)
+            self.counts[name] = np.count_nonzero(~np.isnan(values), axis=1)
+
+    def rank(self, name, col, values):
+        '''
+        数值在某一指标某一年中的百分位，NaN 及该年无数据时为 NaN
+
+        Args:
+            name: Metric name, one of REPORT_METRICS values
+            col: Index of year in panel.years
+            values: numpy.ndarray or float
+        '''
+        n = self.counts[name][col]
+        ordered = self.sorted[name][col, :n]
+        below = np.searchsorted(ordered, values, 'left')
+        above = np.searchsorted(ordered, values, 'right')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(np.isnan(values) | (n == 0), np.nan, (below + above) / 2 / n * 100)
+
+    def percentiles(self, report):
+        '''
+        单一股票报告中各数值在组内的百分位，股票可以不在组内
+
+        Args:
+            report: Report, pandas.DataFrame from AnalysisBase.generate_report()
+        Returns:
+            Percentiles, pandas.DataFrame of the same shape as report
+        '''
+        values = report.to_numpy(dtype=np.float64)
+        result = np.full(values.shape, np.nan)
+        for j, year in enumerate(report.columns):
+            col = self.years.get(str(year))
+            if col is None:
+                continue
+            for i, name in enumerate(report.index):
+                if name in self.sorted:
+                    result[i, j] = self.rank(name, col, values[i, j])
+        return pd.DataFrame(result, index=report.index, columns=report.columns)
+
+    def table(self, attr):
+        '''
+        组内所有股票某一指标各年的百分位，每年一次向量查找
+
+        Args:
+            attr: Metric name in REPORT_METRICS
+        Returns:
+            pandas.DataFrame, ((ticker, exchange) x year)
+        '''
+        values = self.panel.metrics[attr]
+        name = REPORT_METRICS[attr]
+        result = np.column_stack([self.rank(name, col, values[:, col]) for col in range(values.shape[1])]) \
+            if values.size else np.empty(values.shape)
+        return pd.DataFrame(result, index=self.panel.index, columns=self.panel.years)
+
+def load_peer_group(source, group=None, cache='on'):
+    '''
+    读取一组股票作为同业比较的范围
+
+    Args:
+        source: Path of database, or directory of databases
+        group: Group file, see load_group(), None for all tickers in source
+        cache: Cache mode, one of CACHE_MODES
+    Returns:
+        (PeerGroup, list of (ticker, exchange, error message))
+    '''
+    entries = source_tickers(source)
+    if group is not None:
+        tickers = load_group(group)
+        entries = [entry for entry in entries if entry[0] in tickers]
+    if not entries:
+        raise ValueError(f"No ticker of the peer group found in {source}")
+
+    items_by_ticker = {}
+    failures = []
+    with connections():
+        for ticker, exchange, database in entries:
+            # 目录中的多个数据库包含同一股票时只读取第一个，不同交易所的同名股票都读取
+            if (ticker, exchange) in items_by_ticker:
+                continue
+            try:
+                _, items, _ = load_line_items(lambda: connection(database), ticker, exchange,
+                                              make_cache(database, cache))
+                items_by_ticker[(ticker, exchange)] = items
+            except Exception as e:
+                failures.append((ticker, exchange, f"{type(e).__name__}: {e}"))
+
+    return PeerGroup(RatioPanel(items_by_ticker)), failures
+
+# 分析规则: 编号 -> (指标, 检查方式, 参数)
+#   'range': 参数为 (下限, 上限)，在范围内（不含边界）为合格，否则为不合格，NaN 不检查
+#   'trend': 参数为斜率上限，线性拟合 y = k*x + b 的斜率 k 超过上限时整行警告，否则整行合格，
+#            有数据的年份少于 2 个时不检查。参数也可以是 (斜率上限, 最近 n 年, 是否归一化)，
+#            见 trend_slopes()
+RULES = {
+    'R.A1': ('现金流动负债比率', 'range', (1.0, inf)),      # [MUST] 现金流动负债比率 > 100%
+    'R.A2': ('现金流量允当比率', 'range', (1.0, inf)),      # [MUST] 现金流量允当比率 > 100%
+    'R.A3': ('现金再投资比率',   'range', (0.1, inf)),      # [MUST] 现金再投资比率 > 10%
+    'R.A4': ('现金占总资产比率', 'range', (0.1, 0.25)),     # [MUST] 现金占总资产比率 10~25%
+    'R.A5': ('平均收现天数',     'trend', 0.2),             # [MUST] 平均收现天数，没有增加的趋势
+    'R.B1': ('资产周转率',       'range', (1, inf)),        # [NTH]  资产周转率 > 1
+    'R.B2': ('平均销货天数',     'trend', 0.2),             # [MUST] 平均销货天数，没有增加的趋势
+    'R.B3': ('生意完整周期',     'trend', 0.2),             # [MUST] 生意完整周期，没有增加的趋势
+    'R.C1': ('营业毛利率',       'range', (30, inf)),       # [MUST] 营业毛利率 > 30%
+    'R.D1': ('资产负债率',       'range', (-inf, 0.6)),     # [MUST] 资产负债率 < 60%
+    'R.D2': ('长期资产合适率',   'range', (1.5, inf)),      # [MUST] 长期资产合适率 > 150%
+    'R.E1': ('流动比率',         'range', (3.0, inf)),      # [MUST] 流动比率 > 300%
+    'R.E2': ('速动比率',         'range', (1.5, inf)),      # [MUST] 速动比率 > 150%
+}
+
+# 检查结果，verdict_matrix() 中的值为其下标
+VERDICTS = ('', 'pass', 'warn', 'fail')
+VERDICT_NONE, VERDICT_PASS, VERDICT_WARN, VERDICT_FAIL = range(len(VERDICTS))
+
+def trend_slopes(values, x, window=None, normalize=False):
+    '''
+    对每一行做最小二乘线性拟合 y = k*x + b，返回斜率 k。
+    所有行一次计算，NaN 不参与拟合，有数据的点少于 2 个时斜率为 NaN
+
+    Args:
+        values: 2-D numpy.ndarray, one series per row
+        x: 1-D numpy.ndarray, shared by all rows
+        window: Fit only the latest n points with data of each row, None for all
+        normalize: Divide the slope by the absolute value of the mean of the fitted points,
+                   i.e. relative change per unit of x, inf or NaN if the mean is 0
+    Returns:
+        Slopes, 1-D numpy.ndarray
+    '''
+    mask = ~np.isnan(values)
+    if window is not None:
+        mask, _ = last_years(mask, window)
+    n = mask.sum(axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = np.broadcast_to(x, values.shape)
+        x_mean = np.where(mask, x, 0).sum(axis=1) / n
+        y_mean = np.where(mask, values, 0).sum(axis=1) / n
+        xc = np.where(mask, x - x_mean[:, None], 0)
+        yc = np.where(mask, values - y_mean[:, None], 0)
+        slopes = (xc * yc).sum(axis=1) / (xc * xc).sum(axis=1)
+        if normalize:
+            slopes = slopes / np.abs(y_mean)
+
+    return np.where(n >= 2, slopes, np.nan)
+
 class CheckRules():
     '''
     对单一股票的数据进行合规分析，高亮有问题的数据
     '''
-    def __init__(self, report):
+    def __init__(self, report, rules=RULES):
         self.report = report
-        self.rules = [
-            self.rule_a1, self.rule_a2, self.rule_a3, self.rule_a4, self.rule_a5,
-            self.rule_b1, self.rule_b2, self.rule_b3,
-            self.rule_c1,
-            self.rule_d1, self.rule_d2,
-            self.rule_e1, self.rule_e2,
-        ]
+        self.rules = rules
 
         self.style_normal  = 'background-color: #e8f5e9; color: #388e3c'
         self.style_warning = 'background-color: #fff9c4; color: #ef6c00'
         self.style_failure = 'background-color: #ffcdd2; color: #c62828'
 
-    def rule_a1(self, row):
+    def verdict_matrix(self):
         '''
-        R.A1 [MUST] 现金流动负债比率 > 100%
+        一次计算所有规则的检查结果
+
+        Args: None
+        Returns:
+            Verdicts with the same shape as report, numpy.ndarray of index into VERDICTS
+        '''
+        with profile('check'):
+            return self._verdict_matrix()
+
+    def _verdict_matrix(self):
+        values = self.report.to_numpy(dtype=np.float64)
+        verdicts = np.full(values.shape, VERDICT_NONE, dtype=np.int8)
+        rows = {metric: i for i, metric in enumerate(self.report.index)}
+
+        # 每个指标的合格范围，以及是否检查趋势
+        lower = np.full(len(rows), np.nan)
+        upper = np.full(len(rows), np.nan)
+        trend = np.full(len(rows), np.nan)
+        # 按 (window, normalize) 分组计算斜率: {(window, normalize): [row]}
+        trend_groups = {}
+        for metric, method, param in self.rules.values():
+            if metric not in rows:
+                continue
+            if method == 'range':
+                lower[rows[metric]], upper[rows[metric]] = param
+            elif method == 'trend':
+                limit, window, normalize = param if isinstance(param, tuple) else (param, None, False)
+                trend[rows[metric]] = limit
+                trend_groups.setdefault((window, normalize), []).append(rows[metric])
+            else:
+                raise ValueError(f"Unknown rule method '{method}'")
+
+        # Range rules
+        # 边界为 ±inf 时视为无边界，与逐条检查时 inf > 1.0 即合格的结果相同
+        checked = ~np.isnan(lower)[:, None] & ~np.isnan(values)
+        passed = (np.isneginf(lower)[:, None] | (values > lower[:, None])) \
+            & (np.isposinf(upper)[:, None] | (values < upper[:, None]))
+        verdicts[checked & passed] = VERDICT_PASS
+        verdicts[checked & ~passed] = VERDICT_FAIL
+
+        # Trend rules
+        if trend_groups:
+            x = self.report.columns.astype(np.float64).to_numpy()
+            for (window, normalize), trended in trend_groups.items():
+                slopes = trend_slopes(values[trended], x, window, normalize)
+                verdict = np.where(slopes > trend[trended], VERDICT_WARN, VERDICT_PASS)
+                verdicts[trended] = np.where(np.isnan(slopes), VERDICT_NONE, verdict)[:, None]
+
+        return verdicts
+
+    def verdicts(self):
         '''
-        styles = []
-        if row.name == '现金流动负债比率':
-            for col, val in row.items():
-                if pd.isnull(val):
-                    styles.append('')
-                elif val > 1.0: # Pass case
-                    styles.append(self.style_normal)
-                else: # Fail case
-                    styles.append(self.style_failure)
-        else:
-            styles = [''] * len(row)
+        检查结果，不生成 html
+
+        Args: None
+        Returns:
+            Verdicts, pandas.DataFrame of str in VERDICTS, same shape as report
+        '''
+        labels = np.array(VERDICTS, dtype=object)
+        return pd.DataFrame(labels[self.verdict_matrix()],
+                            index=self.report.index, columns=self.report.columns)
+
+    def style_matrix(self):
+        '''
+        各单元格的 css 样式，无检查结果的为 ''
 
-        assert len(styles) == len(row), "Styles length error"
-        return styles
+        Args: None
+        Returns:
+            numpy.ndarray of str, same shape as report
+        '''
+        styles = np.array(['', self.style_normal, self.style_warning, self.style_failure], dtype=object)
+        return styles[self.verdict_matrix()]
 
-    def rule_a2(self, row):
+    def check_all(self):
         '''
-        R.A2 [MUST] 现金流量允当比率 > 100%
+        应用所有分析规则
+
+        Args: None
+        Returns:
+            Report with abnormal data highlight, pandas.DataFrame.style
         '''
-        styles = []
-        if row.name == '现金流量允当比率':
-            for col, val in row.items():
-                if pd.isnull(val):
-                    styles.append('')
-                elif val > 1.0: # Pass case
-                    styles.append(self.style_normal)
-                else: # Fail case
-                    styles.append(self.style_failure)
-        else:
-            styles = [''] * len(row)
+        style_frame = pd.DataFrame(self.style_matrix(), index=self.report.index, columns=self.report.columns)
 
-        assert len(styles) == len(row), "Styles length error"
-        return styles
-    
-    def rule_a3(self, row):
-        '''
-        R.A3 [MUST] 现金再投资比率 > 10%
-        '''
-        styles = []
-        if row.name == '现金再投资比率':
-            for col, val in row.items():
-                if pd.isnull(val):
-                    styles.append('')
-                elif val > 0.1: # Pass case
-                    styles.append(self.style_normal)
-                else: # Fail case
-                    styles.append(self.style_failure)
+        return self.report.style.apply(lambda _: style_frame, axis=None)
+
+# Output style control
+TABLE_STYLES = [
+    dict(selector="table", props=[
+        ("width", "100%"),
+        ("max-width", "100%"),
+        ("min-width", "100%"),
+        ("border-collapse", "collapse"),
+        ("table-layout", 'fixed'),
+    ]),
+
+    dict(selector="th", props=[
+        ("font-size", "110%"),
+        ("text-align", "center"),
+        ("font-weight", "bold"),
+    ]),
+
+    # 1st col header with 20%
+    dict(selector="th:nth-child(1)", props=[("width", "20%")]),
+
+    # other header with 20%
+    dict(selector="th:not(:first-child)", props=[("width", "5%")]),
+
+    dict(selector="td", props=[("text-align", "center")]),
+    #dict(selector="table, th, td", props=[("border", "1px solid black")]),
+
+    dict(selector="th, td", props=[("padding", "1px 1px")]),
+
+    # Set caption
+    dict(selector="caption", props=[
+        ("caption-side", "top"),
+        ("font-size", "150%"),
+        ("font-weight", "bold"),
+        ("text-align", "center"),
+        ("margin", "20px 0 20px 0")
+    ])
+]
+
+def render_report(ticker_analysis, caption, styler=False):
+    '''
+    生成单一股票的 html 报告
+
+    Args:
+        ticker_analysis: AnalysisBase of the ticker
+        caption: Table caption, usually the ticker
+        styler: Render with pandas Styler instead of html_table()
+    Returns:
+        Report in html, str
+    '''
+    return report_html(ticker_analysis.generate_report(), caption, styler)
+
+# 报告中同业百分位列的标题，前面为年份
+PERCENTILE_LABEL = '同业百分位'
+
+def report_html(origin_report, caption, styler=False, percentiles=None):
+    '''
+    将已生成的报告输出为 html，见 render_report()
+
+    Args:
+        percentiles: Percentiles from PeerGroup.percentiles(), the latest year is shown
+                     as an extra column, None for no such column
+    '''
+    styles = CheckRules(origin_report).style_matrix()
+    if percentiles is not None:
+        origin_report = origin_report.assign(
+            **{f"{origin_report.columns[-1]} {PERCENTILE_LABEL}": percentiles.iloc[:, -1]})
+        styles = np.column_stack([styles, np.full(len(styles), '', dtype=object)])
+
+    # Styler 较慢，只在快速输出不支持该报告时使用
+    if styler or not html_renderable(origin_report):
+        style_frame = pd.DataFrame(styles, index=origin_report.index, columns=origin_report.columns)
+        checked_report = origin_report.style.apply(lambda _: style_frame, axis=None)
+        with profile('render'):
+            return style_report(checked_report, caption).to_html()
+
+    with profile('render'):
+        return html_table(origin_report, styles, caption)
+
+def style_report(checked_report, caption):
+    '''
+    设置报告的输出格式
+
+    Args:
+        checked_report: Styler from CheckRules.check_all()
+        caption: Table caption
+    Returns:
+        pandas.io.formats.style.Styler
+    '''
+    ## Format and keep 2 decimal places, NaN to '-'
+    checked_report = checked_report.format("{:.2f}", na_rep='-')
+
+    ## Set table style
+    checked_report = checked_report.set_table_styles(TABLE_STYLES, overwrite=False)
+    return checked_report.set_caption(caption)
+
+# html_table() 的模板，与 Styler.to_html() 的输出相同
+_TABLE_STYLE_BLOCKS = [
+    # Styler 按 ',' 拆分选择器，保留拆分后的空格
+    (selector, ''.join(f"  {prop}: {value};\n" for prop, value in style['props']))
+    for style in TABLE_STYLES for selector in style['selector'].split(',')
+]
+_HEAD_CELL = '      <th id="T_{0}_level0_col{1}" class="col_heading level0 col{1}" >{2}</th>\n'
+_ROW_HEAD = '    <tr>\n      <th id="T_{0}_level0_row{1}" class="row_heading level0 row{1}" >{2}</th>\n'
+_DATA_CELL = '      <td id="T_{0}_row{1}_col{2}" class="data row{1} col{2}" >{3}</td>\n'
+
+def html_renderable(report):
+    '''
+    html_table() 只支持单层、无名称、标签为 str 的行列索引，其他情况使用 Styler
+    '''
+    return all(index.nlevels == 1 and index.name is None and all(isinstance(label, str) for label in index)
+               for index in (report.index, report.columns))
+
+def html_table(report, styles, caption):
+    '''
+    直接输出 html 报告，不经过 Styler 及 jinja 模板，输出与 style_report(...).to_html() 相同:
+    相同的表格样式及单元格样式，数值保留 2 位小数，NaN 为 '-'
+
+    Args:
+        report: Report, pandas.DataFrame of float, see html_renderable()
+        styles: Css of each cell, same shape as report, '' for no style
+        caption: Table caption
+    Returns:
+        Report in html, str
+    '''
+    uid = uuid.uuid4().hex[:5]
+    values = report.to_numpy(dtype=np.float64)
+
+    html = ['<style type="text/css">\n']
+    for selector, props in _TABLE_STYLE_BLOCKS:
+        html.append(f"#T_{uid} {selector} {{\n{props}}}\n")
+
+    # 相同样式的单元格合并为一条 css 规则，按第一次出现的顺序
+    cell_styles = {}
+    for (row, col), style in np.ndenumerate(styles):
+        if style:
+            cell_styles.setdefault(style, []).append(f"#T_{uid}_row{row}_col{col}")
+    for style, selectors in cell_styles.items():
+        props = ''.join(f"  {prop.strip()}: {value.strip()};\n"
+                        for prop, _, value in (p.partition(':') for p in style.split(';') if p.strip()))
+        html.append(f"{', '.join(selectors)} {{\n{props}}}\n")
+    html.append(f'</style>\n<table id="T_{uid}">\n')
+
+    if caption:
+        html.append(f"  <caption>{caption}</caption>\n")
+    html.append('  <thead>\n    <tr>\n      <th class="blank level0" >&nbsp;</th>\n')
+    html.extend(_HEAD_CELL.format(uid, col, label) for col, label in enumerate(report.columns))
+    html.append('    </tr>\n  </thead>\n  <tbody>\n')
+
+    for row, label in enumerate(report.index):
+        html.append(_ROW_HEAD.format(uid, row, label))
+        html.extend(_DATA_CELL.format(uid, row, col, '-' if np.isnan(value) else f"{value:.2f}")
+                    for col, value in enumerate(values[row].tolist()))
+        html.append('    </tr>\n')
+    html.append('  </tbody>\n</table>\n')
+
+    return ''.join(html)
+
+def report_json(report, verdicts, caption, percentiles=None):
+    '''
+    报告及检查结果，可直接输出为 json
+
+    Args:
+        report: Report, pandas.DataFrame from AnalysisBase.generate_report()
+        verdicts: Verdicts, pandas.DataFrame from CheckRules.verdicts()
+        caption: Report caption, usually the ticker
+        percentiles: Percentiles from PeerGroup.percentiles(), or None
+    Returns:
+        Dict of {'ticker': caption, 'years': [year], 'metrics': [{'name', 'values', 'verdicts'}]},
+        with 'percentiles' of each metric if given, NaN values are None
+    '''
+    def to_list(frame):
+        values = frame.to_numpy(dtype=np.float64)
+        return np.where(np.isnan(values), None, values).tolist()
+
+    metrics = [dict(name=name, values=row, verdicts=verdict)
+               for name, row, verdict in zip(report.index, to_list(report), verdicts.to_numpy().tolist())]
+    if percentiles is not None:
+        for metric, row in zip(metrics, to_list(percentiles)):
+            metric['percentiles'] = row
+    return {
+        'ticker': caption,
+        'years': [str(year) for year in report.columns],
+        'metrics': metrics,
+    }
+
+# report_records() 的列: 股票、指标属性名、指标中文名、年份、数值、检查结果
+RECORD_COLUMNS = ['ticker', 'metric', 'name', 'year', 'value', 'verdict']
+
+def report_records(report, verdicts, caption, percentiles=None):
+    '''
+    长格式的报告，每个指标每年一行，便于合并多个股票的报告
+
+    Args:
+        report: Report, pandas.DataFrame from AnalysisBase.generate_report()
+        verdicts: Verdicts, pandas.DataFrame from CheckRules.verdicts()
+        caption: Report caption, usually the ticker
+        percentiles: Percentiles from PeerGroup.percentiles(), or None
+    Returns:
+        pandas.DataFrame of columns RECORD_COLUMNS, and 'percentile' if given
+    '''
+    metrics = {name: attr for attr, name in REPORT_METRICS.items()}
+    rows, cols = report.shape
+    records = pd.DataFrame({
+        'ticker': np.full(rows * cols, caption, dtype=object),
+        'metric': np.repeat(np.array([metrics.get(name, name) for name in report.index], dtype=object), cols),
+        'name': np.repeat(report.index.to_numpy(dtype=object), cols),
+        'year': np.tile(report.columns.astype(str).to_numpy(dtype=object), rows),
+        'value': report.to_numpy(dtype=np.float64).ravel(),
+        'verdict': verdicts.to_numpy(dtype=object).ravel(),
+    }, columns=RECORD_COLUMNS)
+    if percentiles is not None:
+        records['percentile'] = percentiles.to_numpy(dtype=np.float64).ravel()
+    return records
+
+# 输出格式，按输出文件的扩展名选择，其他扩展名按 html 输出
+# parquet 需要 pyarrow，npz 为 numpy 的列存储格式，可用 numpy.load() 一次读入
+OUTPUT_FORMATS = ('html', 'json', 'csv', 'parquet', 'npz')
+
+def output_format(output):
+    ext = os.path.splitext(output)[1].lstrip('.').lower()
+    return ext if ext in OUTPUT_FORMATS else 'html'
+
+def report_outputs(report, caption, formats, peers=None):
+    '''
+    按格式输出报告，检查结果只计算一次
+
+    Args:
+        report: Report, pandas.DataFrame from AnalysisBase.generate_report()
+        caption: Report caption, usually the ticker
+        formats: Iterable of OUTPUT_FORMATS, and 'records' for report_records()
+        peers: PeerGroup to add percentiles to the outputs, or None
+    Returns:
+        Dict of {format: str, bytes, or pandas.DataFrame of 'records'}
+    '''
+    formats = set(formats)
+    percentiles = None if peers is None else peers.percentiles(report)
+    contents = {}
+    if 'html' in formats:
+        contents['html'] = report_html(report, caption, percentiles=percentiles)
+    if formats == {'html'}:
+        return contents
+
+    verdicts = CheckRules(report).verdicts()
+    if 'json' in formats:
+        contents['json'] = json.dumps(report_json(report, verdicts, caption, percentiles), ensure_ascii=False)
+    if formats & {'records', 'csv', 'parquet', 'npz'}:
+        records = report_records(report, verdicts, caption, percentiles)
+        if 'records' in formats:
+            contents['records'] = records
+        for fmt in formats & {'csv', 'parquet', 'npz'}:
+            contents[fmt] = encode_records(records, fmt)
+    return contents
+
+def encode_records(records, fmt):
+    '''
+    将长格式报告编码为 csv (str)、parquet 或 npz (bytes)
+    '''
+    if fmt == 'csv':
+        return records.to_csv(index=False, lineterminator='\n')
+
+    buffer = io.BytesIO()
+    if fmt == 'parquet':
+        # 未安装 pyarrow 时抛出 ImportError
+        records.to_parquet(buffer, index=False)
+    else:
+        # 字符串列存为定长 unicode，numpy.load() 无需 allow_pickle
+        np.savez(buffer, **{name: column.to_numpy(dtype=str if column.dtype == object else column.dtype)
+                            for name, column in records.items()})
+    return buffer.getvalue()
+
+def write_export(contents, output):
+    '''
+    将多个股票的报告一次写入一个文件
+
+    Args:
+        contents: List of report_outputs() results, containing 'json' for json output,
+                  or 'records' for the other formats
+        output: Output file, format by extension, one of 'json', 'csv', 'parquet', 'npz'
+    '''
+    fmt = output_format(output)
+    with profile('render'):
+        if fmt == 'json':
+            data = '[\n' + ',\n'.join(content['json'] for content in contents) + '\n]\n'
         else:
-            styles = [''] * len(row)
+            records = [content['records'] for content in contents]
+            records = pd.concat(records, ignore_index=True) if records else pd.DataFrame(columns=RECORD_COLUMNS)
+            data = encode_records(records, fmt)
+        write_report(data, output)
+
+def write_report(content, output):
+    with profile('write'), open(output, 'wb' if isinstance(content, bytes) else 'w') as file:
+        file.write(content)
+
+def load_manifest(path):
+    '''
+    读取批量报告清单，每行一个报告: ticker database output
+    database 可以是数据库目录，见 DatabaseCatalog。空行及 '#' 开头的注释行会被忽略
+
+    Args:
+        path: Manifest file
+    Returns:
+        List of (ticker, database, output)
+    '''
+    jobs = []
+    with open(path) as file:
+        for lineno, line in enumerate(file, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+
+            fields = line.split()
+            if len(fields) != 3:
+                raise ValueError(f"{path}:{lineno}: expect 'ticker database output', got '{line}'")
+            jobs.append(tuple(fields))
+
+    return jobs
 
-        assert len(styles) == len(row), "Styles length error"
-        return styles
+# 数据库目录的股票索引文件，数据库文件改变时只重新扫描改变的数据库
+CATALOG_FILE = '.tickers.json'
 
-    def rule_a4(self, row):
+class DatabaseCatalog:
+    '''
+    一个目录中所有数据库 (*.db3) 的股票索引，自动查找股票所在的数据库，
+    批量及筛选任务可以把多个数据库当作一个数据集。
+    同一股票同一交易所在多个数据库中时，使用最近更新的数据库
+    '''
+    def __init__(self, directory):
+        '''
+        Args:
+            directory: Directory of databases
+        '''
+        self.directory = directory
+        self.path = os.path.join(directory, CATALOG_FILE)
+
+        # {database file name: {'stamp': [size, mtime], 'tickers': [[ticker, exchange], ...]}}
+        self.databases = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as file:
+                    self.databases = json.load(file)
+            except (OSError, ValueError):
+                pass
+
+        self.refresh()
+
+    def refresh(self):
+        '''
+        扫描新增或改变的数据库，生成 ticker -> {exchange: 数据库} 索引
+        '''
+        found = sorted(os.path.basename(path) for path in glob.glob(os.path.join(self.directory, '*.db3'))
+                       if os.path.isfile(path))
+        changed = set(self.databases) != set(found)
+        self.databases = {name: entry for name, entry in self.databases.items() if name in found}
+
+        for name in found:
+            path = os.path.join(self.directory, name)
+            stamp = list(db_stamp(path))
+            entry = self.databases.get(name)
+            if entry is not None and entry['stamp'] == stamp:
+                continue
+            try:
+                with contextlib.closing(open_readonly(path)) as db:
+                    tickers = list_tickers(db)
+            except sqlite3.DatabaseError as e:
+                print(f"Skip {path}: {e}", file=sys.stderr)
+                tickers = []
+            self.databases[name] = dict(stamp=stamp, tickers=[list(t) for t in tickers])
+            changed = True
+
+        if changed:
+            self.save()
+
+        # 建好后一次替换，在其他线程中刷新时 resolve() 不会读到不完整的索引
+        index = {}
+        for name, entry in sorted(self.databases.items(), key=lambda kv: (kv[1]['stamp'][1], kv[0])):
+            for ticker, exchange in entry['tickers']:
+                index.setdefault(ticker, {})[exchange] = name
+        self.index = index
+
+    def save(self):
+        # 目录不可写时不保存，下次重新扫描
+        try:
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, 'w') as file:
+                json.dump(self.databases, file, indent=2, sort_keys=True)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+    def resolve(self, ticker, exchange=None):
+        '''
+        查找股票所在的数据库
+
+        Args:
+            ticker: Stock ticker
+            exchange: Exchange name, auto detected if None
+        Returns:
+            (path of database, exchange)
         '''
-        R.A4 [MUST] 现金占总资产比率 10~25%
+        exchanges = self.index.get(ticker.upper(), {})
+        if exchange is not None:
+            exchanges = {exch: name for exch, name in exchanges.items() if exch == exchange.lower()}
+
+        if not exchanges:
+            raise ValueError(f"{ticker} is not found in databases of {self.directory}")
+        if len(exchanges) > 1:
+            raise ValueError(f"{ticker} is found in exchanges {sorted(exchanges)}, please specify one")
+
+        (exchange, name), = exchanges.items()
+        return os.path.join(self.directory, name), exchange
+
+    def tickers(self):
         '''
-        styles = []
-        if row.name == '现金占总资产比率':
-            for col, val in row.items():
-                if pd.isnull(val):
-                    styles.append('')
-                elif val > 0.1 and val < 0.25: # Pass case
-                    styles.append(self.style_normal)
-                else: # Fail case
-                    styles.append(self.style_failure)
+        Returns:
+            List of (ticker, exchange, path of database), sorted
+        '''
+        return sorted((ticker, exchange, os.path.join(self.directory, name))
+                      for ticker, exchanges in self.index.items() for exchange, name in exchanges.items())
+
+def source_tickers(source):
+    '''
+    数据库或数据库目录中的所有股票
+
+    Args:
+        source: Path of database, or directory of databases
+    Returns:
+        List of (ticker, exchange, path of database), sorted
+    '''
+    if os.path.isdir(source):
+        return DatabaseCatalog(source).tickers()
+    with contextlib.closing(open_readonly(source, _immutable)) as db:
+        return [(ticker, exchange, source) for ticker, exchange in list_tickers(db)]
+
+def resolve_sources(jobs):
+    '''
+    清单中数据库为目录的，查找股票所在的数据库
+
+    Args:
+        jobs: List of (ticker, database or directory, output)
+    Returns:
+        (List of (ticker, database, output), list of failed (ticker, directory, error message))
+    '''
+    catalogs = {}
+    resolved = []
+    failures = []
+    for ticker, database, output in jobs:
+        if os.path.isdir(database):
+            if database not in catalogs:
+                catalogs[database] = DatabaseCatalog(database)
+            try:
+                database, _ = catalogs[database].resolve(ticker)
+            except ValueError as e:
+                print(f"Fail {ticker} in {database}: {e}", file=sys.stderr)
+                failures.append((ticker, database, str(e)))
+                continue
+        resolved.append((ticker, database, output))
+
+    return resolved, failures
+
+# 缓存模式: 使用缓存，不使用缓存，重建缓存
+CACHE_MODES = ('on', 'off', 'rebuild')
+
+def make_cache(database, mode):
+    '''
+    Args:
+        database: Path of database
+        mode: Cache mode, one of CACHE_MODES
+    Returns:
+        FundamentalsCache, or None if cache is off
+    '''
+    if mode == 'off':
+        return None
+    return FundamentalsCache(database, rebuild=(mode == 'rebuild'))
+
+def report_digest(ticker, fingerprint):
+    '''
+    报告输入的摘要: 原始数据表 (或导入 store 时) 的指纹及报告版本
+
+    Args:
+        ticker: Stock ticker
+        fingerprint: Fingerprint of the raw tables, as AnalysisBase.fingerprint
+    Returns:
+        Digest, hex str
+    '''
+    return hashlib.sha1(f"{REPORT_VERSION}:{ticker}:{fingerprint}".encode()).hexdigest()
+
+# 批量报告的同业比较范围，在各工作进程中设置一次，不随每个任务传递
+_peers = None
+
+def set_peers(peers):
+    global _peers
+    _peers = peers
+
+def generate_ticker_report(job):
+    '''
+    生成单一股票的报告，出错时不抛出异常，以便批量任务继续执行。
+    输入摘要与上次相同时不重新生成
+
+    Args:
+        job: (ticker, database, cache mode, digest of last report or None, formats, metrics database),
+             cache mode is one of CACHE_MODES, formats see report_outputs(),
+             metrics database is from derived_database(), or None to analyze the database
+    Returns:
+        (contents, digest, None) on success, contents is the dict from report_outputs(),
+        or None if the report is unchanged, or (None, None, error message) on failure
+    '''
+    ticker, database, cache, last_digest, formats, derived = job
+    profile_ticker(ticker)
+    try:
+        if derived is not None:
+            digest = load_derived_digest(connection(derived), ticker)
+            if digest == last_digest:
+                return None, digest, None
+            report, _ = load_derived(connection(derived), ticker)
         else:
-            styles = [''] * len(row)
+            ticker_analysis = AnalysisBase(connection(database), ticker, cache=make_cache(database, cache))
+            digest = report_digest(ticker, ticker_analysis.fingerprint)
+            if digest == last_digest:
+                return None, digest, None
+            report = ticker_analysis.generate_report()
 
-        assert len(styles) == len(row), "Styles length error"
-        return styles
+        return report_outputs(report, ticker, formats, _peers), digest, None
+    except Exception as e:
+        return None, None, f"{type(e).__name__}: {e}"
 
-    def rule_a5(self, row):
+class ReportState:
+    '''
+    批量报告的状态文件，记录每个输出文件的输入摘要、报告版本及数据库文件的大小和修改时间，
+    用于跳过输入未改变的报告
+    '''
+    def __init__(self, path, reset=False):
         '''
-        R.A5 [MUST] 平均收现天数，没有增加的趋势
+        Args:
+            path: Path of state file
+            reset: Ignore the recorded state, so that all reports are rebuilt
         '''
-        styles = []
-        if row.name == '平均收现天数':
-            # Fit with y = k*x + b
-            index = [float(i) for i in row.index.tolist()]
-            values = [float(i) for i in row.values]
-            k, b = np.polyfit(index, values, 1)
-            if k > 0.2:
-                styles = [self.style_warning] * len(row)
-            else:
-                styles = [self.style_normal] * len(row)
-        else:
-            styles = [''] * len(row)
+        self.path = path
+        self.entries = {}
+        if not reset and os.path.exists(path):
+            with open(path) as file:
+                self.entries = json.load(file)
+
+    def last_digest(self, database, outputs):
+        '''
+        所有输出文件都存在，且记录的摘要一致时，返回该摘要，否则返回 None
+        '''
+        digests = set()
+        for output in outputs:
+            entry = self.entries.get(output)
+            if entry is None or entry['database'] != database or not os.path.exists(output):
+                return None
+            digests.add(entry['digest'])
 
-        assert len(styles) == len(row), "Styles length error"
-        return styles
+        return digests.pop() if len(digests) == 1 else None
 
-    def rule_b1(self, row):
+    def is_fresh(self, database, outputs):
         '''
-        R.B1 [NTH] 资产周转率 > 1
+        数据库文件及报告版本都未改变时，无需访问数据库即可跳过
         '''
-        styles = []
-        if row.name == '资产周转率':
-            for col, val in row.items():
-                if pd.isnull(val):
-                    styles.append('')
-                elif val > 1 : # Pass case
-                    styles.append(self.style_normal)
-                else: # Fail case
-                    styles.append(self.style_failure)
-        else:
-            styles = [''] * len(row)
+        if self.last_digest(database, outputs) is None:
+            return False
+        stamp = list(db_stamp(database))
+        return all(self.entries[output]['stamp'] == stamp and self.entries[output]['version'] == REPORT_VERSION
+                   for output in outputs)
 
-        assert len(styles) == len(row), "Styles length error"
-        return styles
-    
-    def rule_b2(self, row):
-        '''
-        R.B2 [MUST] 平均销货天数，没有增加的趋势  
-        '''
-        styles = []
-        if row.name == '平均销货天数':
-            # Fit with y = k*x + b
-            index = [float(i) for i in row.index.tolist()]
-            values = [float(i) for i in row.values]
-            k, b = np.polyfit(index, values, 1)
-            if k > 0.2:
-                styles = [self.style_warning] * len(row)
-            else:
-                styles = [self.style_normal] * len(row)
-        else:
-            styles = [''] * len(row)
+    def update(self, database, outputs, digest):
+        stamp = list(db_stamp(database))
+        for output in outputs:
+            self.entries[output] = dict(database=database, digest=digest, stamp=stamp, version=REPORT_VERSION)
 
-        assert len(styles) == len(row), "Styles length error"
-        return styles
-    
-    def rule_b3(self, row):
-        '''
-        R.B3 [MUST] 生意完整周期，没有增加的趋势
-        '''
-        styles = []
-        if row.name == '生意完整周期':
-            # Fit with y = k*x + b
-            index = [float(i) for i in row.index.tolist()]
-            values = [float(i) for i in row.values]
-            k, b = np.polyfit(index, values, 1)
-            if k > 0.2:
-                styles = [self.style_warning] * len(row)
+    def save(self):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as file:
+            json.dump(self.entries, file, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+def imap_profiled(pool, func, tasks, chunksize=1):
+    '''
+    pool.imap()，启用耗时统计时合并各工作进程的统计记录
+    '''
+    if _profiler is None:
+        yield from pool.imap(func, tasks, chunksize)
+        return
+
+    for result, records in pool.imap(functools.partial(profiled_call, func), tasks, chunksize):
+        _profiler.merge(records)
+        yield result
+
+def run_batch(jobs, processes=1, cache='on', state=None, immutable=False, export=None, peers=None):
+    '''
+    批量生成报告，重复的股票只分析一次，输入未改变的报告不重新生成。
+    processes > 1 时将股票分配到多个进程并行分析，结果按清单顺序写出。
+    使用缓存时，数据库有一致的 materialize_metrics() 结果则直接读取其中的指标，见 derived_database()。
+    输出文件的格式按扩展名选择，见 OUTPUT_FORMATS，为 '-' 时不输出单个股票的报告
+
+    Args:
+        jobs: List of (ticker, database or directory of databases, output)
+        processes: Number of worker processes
+        cache: Cache mode, one of CACHE_MODES
+        state: ReportState of last run, None to rebuild all reports
+        immutable: Databases are not modified during the run, see open_readonly()
+        export: Write all reports into this file at the end, see write_export().
+                All reports are rebuilt, since the file needs every ticker
+        peers: PeerGroup to add percentiles to the reports, or None.
+               All reports are rebuilt, since the group may have changed
+    Returns:
+        (List of rebuilt (ticker, database), list of skipped (ticker, database),
+         list of failed (ticker, database, error message))
+    '''
+    jobs, unresolved = resolve_sources(jobs)
+
+    # (ticker, database) -> outputs, in manifest order
+    outputs = {}
+    for ticker, database, output in jobs:
+        targets = outputs.setdefault((ticker.upper(), database), [])
+        if output == '-':
+            continue
+        if output in targets:
+            print(f"Skip {ticker}: {output} is already generated")
+        else:
+            targets.append(output)
+
+    export_format = None
+    if export is not None:
+        export_format = 'json' if output_format(export) == 'json' else 'records'
+    # 合并输出需要所有股票的报告，同业百分位随组内其他股票改变，都不跳过未改变的报告
+    reuse = state is not None and export is None and peers is None
+
+    derived = {database: derived_database(database) if cache == 'on' else None for _, database in outputs}
+
+    skipped = []
+    tasks = []
+    for (ticker, database), targets in outputs.items():
+        if reuse and state.is_fresh(database, targets):
+            skipped.append((ticker, database))
+            continue
+        last_digest = state.last_digest(database, targets) if reuse else None
+        formats = {output_format(output) for output in targets}
+        if export_format is not None:
+            formats.add(export_format)
+        tasks.append((ticker, database, cache, last_digest, tuple(sorted(formats)), derived[database]))
+
+    exported = None if export is None else []
+    # 中途出错时也保存已写出报告的状态，下次不再重新生成
+    try:
+        with connections(immutable):
+            if processes > 1:
+                with multiprocessing.Pool(processes, set_peers, (peers,)) as pool:
+                    results = imap_profiled(pool, generate_ticker_report, tasks)
+                    rebuilt, unchanged, failures = _write_reports(tasks, results, outputs, state, exported)
             else:
-                styles = [self.style_normal] * len(row)
+                previous = _peers
+                set_peers(peers)
+                try:
+                    results = map(generate_ticker_report, tasks)
+                    rebuilt, unchanged, failures = _write_reports(tasks, results, outputs, state, exported)
+                finally:
+                    set_peers(previous)
+
+        if export is not None:
+            write_export(exported, export)
+    finally:
+        if state is not None:
+            state.save()
+
+    return rebuilt, skipped + unchanged, unresolved + failures
+
+def _write_reports(tasks, results, outputs, state, exported=None):
+    rebuilt = []
+    unchanged = []
+    failures = []
+    for (ticker, database, *_), (contents, digest, error) in zip(tasks, results):
+        key = (ticker, database)
+        if error is not None:
+            print(f"Fail {ticker} in {database}: {error}", file=sys.stderr)
+            failures.append((ticker, database, error))
+            continue
+
+        if contents is None:
+            unchanged.append(key)
+            written = outputs[key]
         else:
-            styles = [''] * len(row)
+            # 输出文件不可写时记为失败，继续写出其他报告
+            profile_ticker(ticker)
+            written = []
+            errors = []
+            for output in outputs[key]:
+                try:
+                    write_report(contents[output_format(output)], output)
+                    written.append(output)
+                except OSError as e:
+                    errors.append(f"{type(e).__name__}: {e}")
+            if exported is not None:
+                exported.append(contents)
+            if errors:
+                error = '; '.join(errors)
+                print(f"Fail {ticker} in {database}: {error}", file=sys.stderr)
+                failures.append((ticker, database, error))
+            else:
+                rebuilt.append(key)
 
-        assert len(styles) == len(row), "Styles length error"
-        return styles
-    
-    def rule_c1(self, row):
-        '''
-        R.C1 [MUST] 营业毛利率 > 30%
-        '''
-        styles = []
-        if row.name == '营业毛利率':
-            for col, val in row.items():
-                if pd.isnull(val):
-                    styles.append('')
-                elif val > 30 : # Pass case
-                    styles.append(self.style_normal)
-                else: # Fail case
-                    styles.append(self.style_failure)
-        else:
-            styles = [''] * len(row)
+        if state is not None:
+            state.update(database, written, digest)
 
-        assert len(styles) == len(row), "Styles length error"
-        return styles
+    return rebuilt, unchanged, failures
 
-    def rule_d1(self, row):
-        '''
-        R.D1 [MUST] 资产负债率 < 60%
-        '''
-        styles = []
-        if row.name == '资产负债率':
-            for col, val in row.items():
-                if pd.isnull(val):
-                    styles.append('')
-                elif val < 0.6 : # Pass case
-                    styles.append(self.style_normal)
-                else: # Fail case
-                    styles.append(self.style_failure)
-        else:
-            styles = [''] * len(row)
+def list_tickers(db):
+    '''
+    数据库中所有股票，以 financial summary 表为准，store 中为所有已导入的股票
 
-        assert len(styles) == len(row), "Styles length error"
-        return styles
-    
-    def rule_d2(self, row):
-        '''
-        R.D2 [MUST] 长期资产合适率 > 150%
-        '''
-        styles = []
-        if row.name == '长期资产合适率':
-            for col, val in row.items():
-                if pd.isnull(val):
-                    styles.append('')
-                elif val > 1.5 : # Pass case
-                    styles.append(self.style_normal)
-                else: # Fail case
-                    styles.append(self.style_failure)
+    Args:
+        db: sqlite3.Connection
+    Returns:
+        List of (ticker, exchange), sorted
+    '''
+    if is_store(db):
+        return sorted(db.execute(f"SELECT ticker, exchange FROM {STORE_TICKERS}").fetchall())
+
+    suffix = '_financial_summary'
+    query = "SELECT name FROM sqlite_master WHERE type='table' AND lower(name) LIKE ?"
+    tickers = []
+    for (name,) in db.execute(query, (f"%{suffix}",)):
+        ticker, _, exchange = name[:-len(suffix)].rpartition('_')
+        if ticker:
+            tickers.append((ticker.upper(), exchange.lower()))
+    return sorted(tickers)
+
+def screen_ticker(task):
+    '''
+    检查单一股票某一年的所有规则，统计各检查结果的数量，出错时不抛出异常
+
+    Args:
+        task: (ticker, exchange, database, year or None for the latest year, cache mode,
+               metrics database from derived_database() or None)
+    Returns:
+        ((ticker, exchange, year, pass, warn, fail), None) on success,
+        or (None, error message) on failure
+    '''
+    ticker, exchange, database, year, cache, derived = task
+    profile_ticker(ticker)
+    try:
+        if derived is not None:
+            report, _ = load_derived(connection(derived), ticker, exchange)
+        else:
+            ticker_analysis = AnalysisBase(connection(database), ticker, exchange, make_cache(database, cache))
+            report = ticker_analysis.generate_report()
+        if year is None:
+            col = report.shape[1] - 1
+        elif year in report.columns:
+            col = report.columns.get_loc(year)
         else:
-            styles = [''] * len(row)
+            return None, f"No data in {year}"
 
-        assert len(styles) == len(row), "Styles length error"
-        return styles
+        verdicts = CheckRules(report).verdict_matrix()[:, col]
+        counts = np.bincount(verdicts, minlength=len(VERDICTS))
+        return (ticker, exchange, str(report.columns[col]),
+                int(counts[VERDICT_PASS]), int(counts[VERDICT_WARN]), int(counts[VERDICT_FAIL])), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
 
-    def rule_e1(self, row):
-        '''
-        R.E1 [MUST] 流动比率 > 300%
-        '''
-        styles = []
-        if row.name == '流动比率':
-            for col, val in row.items():
-                if pd.isnull(val):
-                    styles.append('')
-                elif val > 3.0 : # Pass case
-                    styles.append(self.style_normal)
-                else: # Fail case
-                    styles.append(self.style_failure)
+def run_screen(database, year=None, processes=1, cache='on', immutable=False):
+    '''
+    检查数据库中的所有股票，逐个返回结果，不保留各股票的报告。
+    使用缓存时，数据库有一致的 materialize_metrics() 结果则直接读取其中的指标，见 derived_database()
+
+    Args:
+        database: Path of database, or directory of databases, see DatabaseCatalog
+        year: Year to check, None for the latest year of each ticker
+        processes: Number of worker processes
+        cache: Cache mode, one of CACHE_MODES
+        immutable: Database is not modified during the run, see open_readonly()
+    Yields:
+        (ticker, exchange, result, error) as in screen_ticker()
+    '''
+    with connections(immutable):
+        entries = source_tickers(database)
+        derived = {source: derived_database(source) if cache == 'on' else None for _, _, source in entries}
+        tasks = [(ticker, exchange, source, year, cache, derived[source]) for ticker, exchange, source in entries]
+        if processes > 1:
+            with multiprocessing.Pool(processes) as pool:
+                for task, (result, error) in zip(tasks, imap_profiled(pool, screen_ticker, tasks, chunksize=16)):
+                    yield task[0], task[1], result, error
         else:
-            styles = [''] * len(row)
+            for task in tasks:
+                yield (task[0], task[1]) + screen_ticker(task)
 
-        assert len(styles) == len(row), "Styles length error"
-        return styles
+def write_screen(results, file):
+    '''
+    按检查结果排名，不合格最少的在前，其次是警告最少、合格最多的，输出 csv
 
-    def rule_e2(self, row):
-        '''
-        R.E2 [MUST] 速动比率 > 150%
-        '''
-        styles = []
-        if row.name == '速动比率':
-            for col, val in row.items():
-                if pd.isnull(val):
-                    styles.append('')
-                elif val > 1.5 : # Pass case
-                    styles.append(self.style_normal)
-                else: # Fail case
-                    styles.append(self.style_failure)
+    Args:
+        results: Iterable of (ticker, exchange, result, error) from run_screen()
+        file: Output file object
+    Returns:
+        (Number of tickers screened, list of (ticker, exchange, error message))
+    '''
+    rows = []
+    failures = []
+    for ticker, exchange, result, error in results:
+        if error is not None:
+            print(f"Fail {ticker} in {exchange}: {error}", file=sys.stderr)
+            failures.append((ticker, exchange, error))
         else:
-            styles = [''] * len(row)
+            rows.append(result)
+
+    rows.sort(key=lambda row: (row[5], row[4], -row[3], row[0]))
+
+    writer = csv.writer(file)
+    writer.writerow(['rank', 'ticker', 'exchange', 'year', 'pass', 'warn', 'fail'])
+    for rank, row in enumerate(rows, 1):
+        writer.writerow((rank,) + row)
+
+    return len(rows), failures
+
+# 预先计算的指标及检查结果，默认写入数据库旁的 <database>.metrics.db3，也可以写入数据库本身
+DERIVED_TABLE = 'derived_metrics'
+DERIVED_TICKERS = 'derived_tickers'
+DERIVED_INFO = 'derived_info'
+
+DERIVED_SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS {DERIVED_TABLE} (
+    ticker TEXT, exchange TEXT, metric TEXT, name TEXT, year TEXT, value REAL, verdict TEXT,
+    PRIMARY KEY (ticker, exchange, metric, year)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS {DERIVED_TABLE}_metric_year ON {DERIVED_TABLE} (metric, year);
+CREATE TABLE IF NOT EXISTS {DERIVED_TICKERS} (
+    ticker TEXT, exchange TEXT, digest TEXT, PRIMARY KEY (ticker, exchange)
+);
+CREATE TABLE IF NOT EXISTS {DERIVED_INFO} (key TEXT PRIMARY KEY, value TEXT);
+'''
+
+def derive_ticker(task):
+    '''
+    计算单一股票的所有指标及检查结果，输入摘要与上次相同时不重新计算，出错时不抛出异常
 
-        assert len(styles) == len(row), "Styles length error"
-        return styles
-    
-    def check_all(self):
-        '''
-        应用所有分析规则
+    Args:
+        task: (ticker, exchange, database, cache mode, digest of last run or None)
+    Returns:
+        (digest, records, None) on success, records is from report_records(), or None if unchanged,
+        or (None, None, error message) on failure
+    '''
+    ticker, exchange, database, cache, last_digest = task
+    profile_ticker(ticker)
+    try:
+        ticker_analysis = AnalysisBase(connection(database), ticker, exchange, make_cache(database, cache))
+        digest = report_digest(ticker, ticker_analysis.fingerprint)
+        if digest == last_digest:
+            return digest, None, None
+
+        records = report_outputs(ticker_analysis.generate_report(), ticker, ['records'])['records']
+        return digest, records, None
+    except Exception as e:
+        return None, None, f"{type(e).__name__}: {e}"
+
+def materialize_metrics(database, target=None, processes=1, cache='on', immutable=False):
+    '''
+    将数据库中所有股票的指标及检查结果写入 derived_metrics 表，每个股票每个指标每年一行。
+    只重新计算原始数据改变的股票，删除数据库中已不存在的股票。
+    全部成功时在 derived_info 表中记录数据库文件的大小、修改时间及报告版本，见 derived_database()
+
+    Args:
+        database: Path of database
+        target: Path of output database, default <database>.metrics.db3, may be database itself
+        processes: Number of worker processes
+        cache: Cache mode, one of CACHE_MODES
+        immutable: Database is not modified during the run, see open_readonly()
+    Returns:
+        (Number of refreshed tickers, number of unchanged tickers, list of (ticker, exchange, error message))
+    '''
+    target = target or f"{database}.metrics.db3"
+    # 读取数据前记录，运行中数据库有更新时不会被误认为一致
+    stamp = json.dumps(list(db_stamp(database)))
+    out = sqlite3.connect(target)
+    try:
+        out.executescript(DERIVED_SCHEMA)
+        digests = {(ticker, exchange): digest for ticker, exchange, digest
+                   in out.execute(f"SELECT ticker, exchange, digest FROM {DERIVED_TICKERS}")}
+
+        refreshed, unchanged, failures = 0, 0, []
+        with connections(immutable), contextlib.ExitStack() as stack:
+            tasks = [(ticker, exchange, database, cache, digests.pop((ticker, exchange), None))
+                     for ticker, exchange, _ in source_tickers(database)]
+            if processes > 1:
+                pool = stack.enter_context(multiprocessing.Pool(processes))
+                results = imap_profiled(pool, derive_ticker, tasks, chunksize=16)
+            else:
+                results = map(derive_ticker, tasks)
+
+            # 所有股票在一个事务中写入
+            with out:
+                for (ticker, exchange, *_), (digest, records, error) in zip(tasks, results):
+                    if error is not None:
+                        failures.append((ticker, exchange, error))
+                        continue
+                    if records is None:
+                        unchanged += 1
+                        continue
+
+                    values = records['value'].to_numpy()
+                    rows = zip(itertools.repeat(ticker), itertools.repeat(exchange),
+                               records['metric'], records['name'], records['year'],
+                               np.where(np.isnan(values), None, values).tolist(), records['verdict'])
+                    out.execute(f"DELETE FROM {DERIVED_TABLE} WHERE ticker = ? AND exchange = ?", (ticker, exchange))
+                    out.executemany(f"INSERT INTO {DERIVED_TABLE} VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+                    out.execute(f"INSERT OR REPLACE INTO {DERIVED_TICKERS} VALUES (?, ?, ?)", (ticker, exchange, digest))
+                    refreshed += 1
+
+                # 剩下的是数据库中已不存在的股票
+                for ticker, exchange in digests:
+                    out.execute(f"DELETE FROM {DERIVED_TABLE} WHERE ticker = ? AND exchange = ?", (ticker, exchange))
+                    out.execute(f"DELETE FROM {DERIVED_TICKERS} WHERE ticker = ? AND exchange = ?", (ticker, exchange))
+
+                # 有失败的股票时表中数据不完整，不可代替重新计算
+                if failures:
+                    out.execute(f"DELETE FROM {DERIVED_INFO} WHERE key = 'stamp'")
+                else:
+                    out.executemany(f"INSERT OR REPLACE INTO {DERIVED_INFO} VALUES (?, ?)",
+                                    [('stamp', stamp), ('version', str(REPORT_VERSION))])
+        out.execute("ANALYZE")
+    finally:
+        out.close()
+
+    return refreshed, unchanged, failures
+
+def derived_database(database):
+    '''
+    与数据库一致的 materialize_metrics() 结果: <database>.metrics.db3 中记录的数据库文件大小、
+    修改时间及报告版本都与当前相同时，可以直接读取其中的指标，不访问原始数据。
+    结果写入数据库本身时，写入即改变了数据库，不会被使用
+
+    Args:
+        database: Path of database
+    Returns:
+        Path of metrics database, or None if it does not exist or is out of date
+    '''
+    target = f"{database}.metrics.db3"
+    if not os.path.isfile(database) or not os.path.exists(target):
+        return None
 
-        Args: None
-        Returns:
-            Report with abnormal data highlight, pandas.DataFrame.style
-        '''
-        styler = self.report.style
-        for func in self.rules:
-            styler = styler.apply(func, axis=1)
+    with contextlib.closing(open_readonly(target)) as db:
+        try:
+            info = dict(db.execute(f"SELECT key, value FROM {DERIVED_INFO}").fetchall())
+        except sqlite3.OperationalError:
+            return None
+
+    if info.get('version') != str(REPORT_VERSION) or info.get('stamp') != json.dumps(list(db_stamp(database))):
+        return None
+    return target
+
+def load_derived_digest(db, ticker):
+    '''
+    derived_tickers 表中记录的输入摘要，与 report_digest() 相同
 
-        return styler
+    Args:
+        db: sqlite3.Connection of the database written by materialize_metrics()
+        ticker: Stock ticker, in only one exchange
+    Returns:
+        Digest, hex str
+    '''
+    with profile('read_sql'):
+        query = f"SELECT exchange, digest FROM {DERIVED_TICKERS} WHERE ticker = ?"
+        rows = db.execute(query, (ticker.upper(),)).fetchall()
+    if not rows:
+        raise ValueError(f"No derived metrics of {ticker} found")
+    if len(rows) > 1:
+        raise ValueError(f"{ticker} is found in exchanges {sorted(row[0] for row in rows)}, please specify one")
+    return rows[0][1]
+
+def load_derived(db, ticker, exchange=None):
+    '''
+    从 derived_metrics 表读取单一股票的报告及检查结果，一次索引查询
+
+    Args:
+        db: sqlite3.Connection of the database written by materialize_metrics()
+        ticker: Stock ticker
+        exchange: Exchange name, None if the ticker is in only one exchange
+    Returns:
+        (report, verdicts), same as AnalysisBase.generate_report() and CheckRules.verdicts()
+    '''
+    query = f"SELECT exchange, metric, year, value, verdict FROM {DERIVED_TABLE} WHERE ticker = ?"
+    params = (ticker.upper(),)
+    if exchange is not None:
+        query += " AND exchange = ?"
+        params += (exchange.lower(),)
+    with profile('read_sql'):
+        rows = db.execute(query, params).fetchall()
+
+    if not rows:
+        raise ValueError(f"No derived metrics of {ticker} found")
+    if len({row[0] for row in rows}) > 1:
+        raise ValueError(f"{ticker} is found in exchanges {sorted({row[0] for row in rows})}, please specify one")
+
+    metrics = {attr: i for i, attr in enumerate(REPORT_METRICS)}
+    years = sorted({row[2] for row in rows})
+    columns = {year: i for i, year in enumerate(years)}
+    values = np.full((len(metrics), len(years)), np.nan)
+    verdicts = np.full(values.shape, '', dtype=object)
+    for _, metric, year, value, verdict in rows:
+        if value is not None:
+            values[metrics[metric], columns[year]] = value
+        verdicts[metrics[metric], columns[year]] = verdict
+
+    index = list(REPORT_METRICS.values())
+    return (pd.DataFrame(values, index=index, columns=years),
+            pd.DataFrame(verdicts, index=index, columns=years))
+
+def write_profile(profiler, path, top=10):
+    profiler.print_summary(sys.stderr, top)
+    profiler.write(path)
 
 def main():
     parser = OptionParser()
@@ -661,15 +2824,180 @@ def main():
                 help="Stock ticker")
     parser.add_option("-o", "--output",
                 action="store", dest="output",
-                help="output html")
+                help="Output file, format by extension: .json, .csv, .parquet (requires pyarrow), .npz, "
+                     "html otherwise")
     parser.add_option("--db", "--database",
                 action="store", dest="database",
-                help="Finance database, which is saved by msfinance")
+                help="Finance database, which is saved by msfinance, or a directory of databases "
+                     "where the database of each ticker is looked up")
+    parser.add_option("-e", "--exchange",
+                action="store", dest="exchange",
+                help="Stock exchange, e.g. xnas, auto detected from database if not given")
+    parser.add_option("-m", "--manifest",
+                action="store", dest="manifest",
+                help="Batch mode, generate all reports listed in manifest, one 'ticker database output' per line, "
+                     "output format by extension as --output, '-' for no output of the ticker. "
+                     "Only reports with changed inputs are rebuilt, see <manifest>.state")
+    parser.add_option("--export",
+                action="store", dest="export",
+                help="Batch mode, also write all reports with rule verdicts into one .json, .csv, .parquet "
+                     "or .npz file, one row per ticker, metric and year except json. Rebuilds all reports")
+    parser.add_option("-s", "--screen",
+                action="store_true", dest="screen", default=False,
+                help="Screen mode, check all tickers in database and rank them by rule verdicts, "
+                     "output csv to --output or stdout")
+    parser.add_option("-y", "--year",
+                action="store", dest="year",
+                help="Screen mode, year to check, default the latest year of each ticker")
+    parser.add_option("-j", "--jobs",
+                action="store", dest="jobs", type="int", default=1,
+                help="Number of worker processes in batch and screen mode, 0 for all CPUs, default 1")
+    parser.add_option("-f", "--force",
+                action="store_true", dest="force", default=False,
+                help="Batch mode, rebuild all reports even if their inputs are unchanged")
+    parser.add_option("--no-cache",
+                action="store_const", dest="cache", const='off', default='on',
+                help="Bypass the cache of parsed fundamentals, always read from database")
+    parser.add_option("--rebuild-cache",
+                action="store_const", dest="cache", const='rebuild',
+                help="Re-parse fundamentals from database and rebuild the cache")
+    parser.add_option("--immutable",
+                action="store_true", dest="immutable", default=False,
+                help="Batch and screen mode, databases are not modified during the run, "
+                     "open them immutable to skip sqlite locking")
+    parser.add_option("--build-catalog",
+                action="store_true", dest="build_catalog", default=False,
+                help="Build the table catalog of --database, so that tables are looked up by ticker "
+                     "instead of scanning sqlite_master")
+    parser.add_option("--import-store",
+                action="store", dest="store",
+                help="Import fundamentals of all tickers in the databases given as arguments into a "
+                     "normalized store, which can be used as --database")
+    parser.add_option("--peers",
+                action="store", dest="peers",
+                help="Database or directory of databases of peer tickers, add the percentile of each metric "
+                     "among them to reports, the latest year as an extra column")
+    parser.add_option("--peer-group",
+                action="store", dest="peer_group",
+                help="Only tickers in this file are peers, a page in docs/ such as docs/CPU.md, "
+                     "or a ticker list with the ticker as the last field of each line")
+    parser.add_option("--materialize",
+                action="store_true", dest="materialize", default=False,
+                help="Compute metrics and rule verdicts of all tickers in --database into a derived_metrics "
+                     "table, only tickers with changed data are recomputed. Batch and screen mode read "
+                     "the metrics from <database>.metrics.db3 while the database is unchanged")
+    parser.add_option("--metrics-db",
+                action="store", dest="metrics_db",
+                help="Output database of --materialize, default <database>.metrics.db3, "
+                     "may be --database itself")
+    parser.add_option("--profile",
+                action="store", dest="profile",
+                help="Record time and calls of each stage per ticker, save to a json or csv file "
+                     "and print a summary to stderr")
+    parser.add_option("--profile-top",
+                action="store", dest="profile_top", type="int", default=10,
+                help="Number of slowest tickers in profile summary, default 10")
 
     (opts, args) = parser.parse_args()
 
+    # 在读取数据前检查报告的输出格式，避免全部生成后才失败
+    if opts.manifest:
+        output = opts.export
+        if output and output_format(output) == 'html':
+            parser.error("--export must be a .json, .csv, .parquet or .npz file")
+    elif not (opts.build_catalog or opts.store or opts.materialize or opts.screen):
+        output = opts.output
+    else:
+        output = None
+    if output and output_format(output) == 'parquet' and importlib.util.find_spec('pyarrow') is None:
+        parser.error(f"pyarrow is required to write {output}, use .npz instead")
+
+    if opts.profile:
+        profiler = Profiler()
+        set_profiler(profiler)
+        atexit.register(write_profile, profiler, opts.profile, opts.profile_top)
+
+    peers = None
+    if opts.peer_group and not opts.peers:
+        parser.error("--peers is required with --peer-group")
+    if opts.peers:
+        try:
+            peers, failures = load_peer_group(opts.peers, opts.peer_group, opts.cache)
+        except ValueError as e:
+            parser.error(str(e))
+        for ticker, exchange, error in failures:
+            print(f"Fail peer {ticker} in {exchange}: {error}", file=sys.stderr)
+        print(f"{len(peers.panel.tickers)} peers loaded from {opts.peers}", file=sys.stderr)
+
+    if opts.manifest:
+        jobs = load_manifest(opts.manifest)
+        processes = opts.jobs if opts.jobs > 0 else multiprocessing.cpu_count()
+        state = ReportState(f"{opts.manifest}.state", reset=opts.force)
+        rebuilt, skipped, failures = run_batch(jobs, processes, opts.cache, state, opts.immutable, opts.export, peers)
+        for ticker, database in rebuilt:
+            print(f"Rebuilt {ticker} from {database}")
+        if skipped:
+            print(f"Skipped {len(skipped)} unchanged: {' '.join(ticker for ticker, _ in skipped)}")
+        print(f"{len(rebuilt)} rebuilt, {len(skipped)} skipped, {len(failures)} failed")
+        if failures:
+            sys.exit(1)
+        return
+
+    if opts.build_catalog:
+        if not opts.database:
+            parser.error("--database is required to build the table catalog")
+        count = build_catalog(opts.database)
+        print(f"{count} tables indexed in {CATALOG_TABLE}")
+        return
+
+    if opts.store:
+        if not args:
+            parser.error("databases to import are required")
+        imported, unchanged, failures = import_store(opts.store, args)
+        for ticker, database, error in failures:
+            print(f"Fail {ticker} in {database}: {error}", file=sys.stderr)
+        print(f"{imported} imported, {unchanged} unchanged, {len(failures)} failed")
+        if failures:
+            sys.exit(1)
+        return
+
+    if opts.materialize:
+        if not opts.database or os.path.isdir(opts.database):
+            parser.error("--database of a single database is required to materialize metrics")
+        processes = opts.jobs if opts.jobs > 0 else multiprocessing.cpu_count()
+        refreshed, unchanged, failures = materialize_metrics(opts.database, opts.metrics_db, processes,
+                                                             opts.cache, opts.immutable)
+        for ticker, exchange, error in failures:
+            print(f"Fail {ticker} in {exchange}: {error}", file=sys.stderr)
+        print(f"{refreshed} refreshed, {unchanged} unchanged, {len(failures)} failed")
+        if failures:
+            sys.exit(1)
+        return
+
+    if opts.screen:
+        if not opts.database:
+            parser.error("--database is required in screen mode")
+        processes = opts.jobs if opts.jobs > 0 else multiprocessing.cpu_count()
+        file = open(opts.output, 'w', newline='') if opts.output else sys.stdout
+        try:
+            count, failures = write_screen(run_screen(opts.database, opts.year, processes, opts.cache, opts.immutable), file)
+        finally:
+            if opts.output:
+                file.close()
+        print(f"{count} tickers screened, {len(failures)} failed", file=sys.stderr)
+        return
+
+    if not (opts.ticker and opts.database and opts.output):
+        parser.error("--ticker, --database and --output are required without --manifest or --screen")
+
+    profile_ticker(opts.ticker)
+    database, exchange = opts.database, opts.exchange
+    if os.path.isdir(database):
+        database, exchange = DatabaseCatalog(database).resolve(opts.ticker, exchange)
+
     # Temp test code
-    ticker_analysis = AnalysisBase(opts.database, opts.ticker)
+    cache = make_cache(database, opts.cache)
+    ticker_analysis = AnalysisBase(database, opts.ticker, exchange, cache)
 
 # Unit Test Case
 #    print("cash_flow_ratio:\n",             ticker_analysis.get_cash_flow_ratio())
@@ -694,63 +3022,12 @@ def main():
 #    print("quick_ratio:\n",                 ticker_analysis.get_quick_ratio())
 #    print("Report:\n",                      ticker_analysis.generate_report())
 
-    origin_report = ticker_analysis.generate_report()
-    report = CheckRules(origin_report)
-    checked_report = report.check_all()
-
-
-    # Output style control
-    ## Format and keep 2 decimal places, NaN to '-'
-    checked_report = checked_report.format("{:.2f}", na_rep='-')
-
-    ## Set table style
-    table_styles = [
-        dict(selector="table", props=[
-            ("width", "100%"),
-            ("max-width", "100%"),
-            ("min-width", "100%"),
-            ("border-collapse", "collapse"),
-            ("table-layout", 'fixed'),
-        ]),
-        
-        dict(selector="th", props=[
-            ("font-size", "110%"),
-            ("text-align", "center"),
-            ("font-weight", "bold"),
-        ]),
-
-        # 1st col header with 20%
-        dict(selector="th:nth-child(1)", props=[("width", "20%")]),
-        
-        # other header with 20%
-        dict(selector="th:not(:first-child)", props=[("width", "5%")]), 
-        
-        dict(selector="td", props=[("text-align", "center")]),
-        #dict(selector="table, th, td", props=[("border", "1px solid black")]),
-        
-        dict(selector="th, td", props=[("padding", "1px 1px")]),
-        
-        # Set caption
-        dict(selector="caption", props=[
-            ("caption-side", "top"),
-            ("font-size", "150%"),
-            ("font-weight", "bold"),
-            ("text-align", "center"),  
-            ("margin", "20px 0 20px 0")
-        ])
-    ]
-    checked_report = checked_report.set_table_styles(table_styles, overwrite=False)
-    checked_report = checked_report.set_caption(opts.ticker)
-    
-    # Render to html 
-    html = checked_report.to_html()
-
-    with open(opts.output, 'w') as file:
-        file.write(html)
+    fmt = output_format(opts.output)
+    contents = report_outputs(ticker_analysis.generate_report(), opts.ticker, [fmt], peers)
+    ticker_analysis.close()
+    write_report(contents[fmt], opts.output)
 
 
 if __name__ == '__main__':
     main()
 
-
-
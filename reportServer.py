@@ -0,0 +1,302 @@
+#!/usr/bin/python3 -u
+'''
+报告服务: 常驻进程，按需生成股票报告 (html / json)，结果保存在内存中，
+数据库文件改变时重新生成
+
+    GET /report/<ticker>.html[?exchange=xnas]
+    GET /report/<ticker>.json[?exchange=xnas]
+    GET /stats
+'''
+import os
+import json
+import time
+import asyncio
+import contextlib
+import collections
+import concurrent.futures
+import multiprocessing
+import urllib.parse
+from optparse import OptionParser
+
+import jmStockAnalysis as jm
+
+def build_report(database, ticker, exchange, cache):
+    '''
+    在工作进程中生成报告，每次打开新的连接，数据库文件被替换后也能读到新数据
+
+    Returns:
+        (html, json text)
+    '''
+    with contextlib.closing(jm.open_readonly(database)) as db:
+        ticker_analysis = jm.AnalysisBase(db, ticker, exchange, jm.make_cache(database, cache))
+        contents = jm.report_outputs(ticker_analysis.generate_report(), ticker, ('html', 'json'))
+    return contents['html'], contents['json']
+
+class ReportCache:
+    '''
+    已生成报告的 LRU 缓存，总大小不超过 budget 字节。
+    每项记录生成时数据库的版本，版本改变后失效
+    '''
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # {key: (version, html bytes, json bytes)}
+        self.entries = collections.OrderedDict()
+
+    def get(self, key, version):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != version:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, version, html, json_text):
+        self.discard(key)
+        entry = (version, html.encode(), json_text.encode())
+        self.entries[key] = entry
+        self.size += len(entry[1]) + len(entry[2])
+
+        # 至少保留刚加入的一项
+        while self.size > self.budget and len(self.entries) > 1:
+            self.discard(next(iter(self.entries)))
+        return entry
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1]) + len(entry[2])
+
+    def stats(self):
+        return dict(entries=len(self.entries), bytes=self.size, budget=self.budget,
+                    hits=self.hits, misses=self.misses)
+
+class ReportService:
+    '''
+    查找股票所在数据库，检查数据库版本，缓存未命中时在进程池中生成报告
+    '''
+    def __init__(self, source, pool, cache_budget, cache='on', refresh_interval=10.0):
+        '''
+        Args:
+            source: Path of database, or directory of databases
+            pool: concurrent.futures.Executor running build_report()
+            cache_budget: Memory budget of cached reports in bytes
+            cache: Cache mode of parsed fundamentals, one of jmStockAnalysis.CACHE_MODES
+            refresh_interval: Minimum seconds between two rescans of the directory for unknown tickers
+        '''
+        self.source = source
+        self.pool = pool
+        self.cache = cache
+        self.reports = ReportCache(cache_budget)
+        self.catalog = jm.DatabaseCatalog(source) if os.path.isdir(source) else None
+        # 重新扫描目录的时间及正在进行的扫描，不存在的股票不会每次请求都扫描
+        self.refresh_interval = refresh_interval
+        self.refreshed = time.monotonic()
+        self.refreshing = None
+        # 每个数据库一个只读连接，用于读取 data_version: {database: (stamp, connection)}
+        self.connections = {}
+        # 正在生成的报告，相同的请求只生成一次
+        self.pending = {}
+
+    async def resolve(self, ticker, exchange):
+        if self.catalog is None:
+            return self.source
+        try:
+            return self.catalog.resolve(ticker, exchange)[0]
+        except ValueError:
+            # 可能是新加入的数据库
+            await self.refresh()
+            return self.catalog.resolve(ticker, exchange)[0]
+
+    async def refresh(self):
+        '''
+        重新扫描数据库目录，至多每 refresh_interval 秒一次。
+        扫描可能打开所有数据库，在线程中进行，不阻塞其他连接；同时到达的请求等待同一次扫描
+        '''
+        if self.refreshing is None:
+            if time.monotonic() - self.refreshed < self.refresh_interval:
+                return
+            self.refreshed = time.monotonic()
+            self.refreshing = asyncio.get_running_loop().run_in_executor(None, self.catalog.refresh)
+            self.refreshing.add_done_callback(lambda _: setattr(self, 'refreshing', None))
+        await asyncio.shield(self.refreshing)
+
+    def version(self, database):
+        '''
+        数据库版本: 文件大小、修改时间及 data_version，
+        data_version 在其他连接提交修改后改变，可发现 WAL 模式下尚未写回主文件的修改
+        '''
+        stamp = jm.db_stamp(database)
+        known = self.connections.get(database)
+        if known is None or known[0] != stamp:
+            # 文件被替换时需重新打开
+            if known is not None:
+                known[1].close()
+            known = (stamp, jm.open_readonly(database))
+            self.connections[database] = known
+        data_version = known[1].execute("PRAGMA data_version").fetchone()[0]
+        return stamp + (data_version,)
+
+    async def report(self, ticker, exchange=None):
+        '''
+        Returns:
+            (version, html bytes, json bytes)
+        '''
+        ticker = ticker.upper()
+        database = await self.resolve(ticker, exchange)
+        key = (database, ticker, exchange)
+        version = self.version(database)
+
+        entry = self.reports.get(key, version)
+        if entry is not None:
+            return entry
+
+        task = self.pending.get((key, version))
+        if task is None:
+            task = asyncio.ensure_future(self.build(key, version, database, ticker, exchange))
+            self.pending[(key, version)] = task
+            task.add_done_callback(lambda _: self.pending.pop((key, version), None))
+        # 客户端断开时不取消，其他请求可能也在等待
+        return await asyncio.shield(task)
+
+    async def build(self, key, version, database, ticker, exchange):
+        loop = asyncio.get_running_loop()
+        html, json_text = await loop.run_in_executor(self.pool, build_report, database, ticker, exchange, self.cache)
+        return self.reports.put(key, version, html, json_text)
+
+    def stats(self):
+        return dict(source=self.source, cache=self.reports.stats(), pending=len(self.pending))
+
+STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+          500: 'Internal Server Error'}
+
+async def handle(service, reader, writer):
+    '''
+    处理一个连接，支持 HTTP/1.1 keep-alive
+    '''
+    try:
+        while True:
+            request = await reader.readline()
+            if not request:
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            start = time.perf_counter()
+            status, content_type, body = await respond(service, request.decode('latin-1').split())
+            keep_alive = headers.get('connection', '').lower() != 'close' and request.rstrip().endswith(b'HTTP/1.1')
+            writer.write((f"HTTP/1.1 {status} {STATUS[status]}\r\n"
+                          f"Content-Type: {content_type}\r\n"
+                          f"Content-Length: {len(body)}\r\n"
+                          f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode() + body)
+            await writer.drain()
+            print(f"{request.decode('latin-1').strip()} {status} {(time.perf_counter() - start) * 1000:.1f}ms")
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def respond(service, request):
+    '''
+    Returns:
+        (status, content type, body bytes)
+    '''
+    if len(request) < 2:
+        return 400, 'text/plain', b'Bad request\n'
+    method, target = request[:2]
+    if method != 'GET':
+        return 405, 'text/plain', b'Only GET is supported\n'
+
+    url = urllib.parse.urlsplit(target)
+    query = dict(urllib.parse.parse_qsl(url.query))
+
+    if url.path == '/stats':
+        return 200, 'application/json', json.dumps(service.stats()).encode()
+
+    name = url.path[len('/report/'):] if url.path.startswith('/report/') else ''
+    ticker, _, ext = name.rpartition('.')
+    if not ticker or ext not in ('html', 'json'):
+        return 404, 'text/plain', b'Use /report/<ticker>.html or /report/<ticker>.json\n'
+
+    try:
+        _, html, json_bytes = await service.report(ticker, query.get('exchange'))
+    except ValueError as e:
+        return 404, 'text/plain', f"{e}\n".encode()
+    except Exception as e:
+        return 500, 'text/plain', f"{type(e).__name__}: {e}\n".encode()
+
+    if ext == 'html':
+        return 200, 'text/html; charset=utf-8', html
+    return 200, 'application/json', json_bytes
+
+async def serve(service, host=None, port=None, unix=None):
+    callback = lambda reader, writer: handle(service, reader, writer)
+    if unix:
+        server = await asyncio.start_unix_server(callback, path=unix)
+        print(f"Serving {service.source} on {unix}")
+    else:
+        server = await asyncio.start_server(callback, host, port)
+        print(f"Serving {service.source} on http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+def main():
+    parser = OptionParser()
+
+    parser.add_option("--db", "--database",
+                action="store", dest="database",
+                help="Finance database, or a directory of databases")
+    parser.add_option("--host",
+                action="store", dest="host", default='127.0.0.1',
+                help="Listen address, default 127.0.0.1")
+    parser.add_option("-p", "--port",
+                action="store", dest="port", type="int", default=8765,
+                help="Listen port, default 8765")
+    parser.add_option("--unix",
+                action="store", dest="unix",
+                help="Listen on a unix socket instead of tcp")
+    parser.add_option("-j", "--jobs",
+                action="store", dest="jobs", type="int", default=0,
+                help="Number of worker processes, default all CPUs")
+    parser.add_option("--cache-mb",
+                action="store", dest="cache_mb", type="int", default=256,
+                help="Memory budget of cached reports in MB, default 256")
+    parser.add_option("--no-cache",
+                action="store_const", dest="cache", const='off', default='on',
+                help="Bypass the cache of parsed fundamentals, always read from database")
+    parser.add_option("--refresh-interval",
+                action="store", dest="refresh_interval", type="float", default=10.0,
+                help="Minimum seconds between two rescans of the database directory "
+                     "for tickers not found, default 10")
+
+    (opts, args) = parser.parse_args()
+
+    if not opts.database:
+        parser.error("--database is required")
+
+    jobs = opts.jobs if opts.jobs > 0 else multiprocessing.cpu_count()
+    # 工作进程在第一次请求时才创建，从 forkserver 创建，不继承客户端连接。
+    # jmStockAnalysis 延迟导入 pandas，预先导入，工作进程无需各自导入
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(['numpy', 'pandas', 'jmStockAnalysis'])
+    with concurrent.futures.ProcessPoolExecutor(jobs, mp_context=context) as pool:
+        service = ReportService(opts.database, pool, opts.cache_mb * 1024 * 1024, opts.cache,
+                                opts.refresh_interval)
+        try:
+            asyncio.run(serve(service, opts.host, opts.port, opts.unix))
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
@@ -1,50 +1,323 @@
 #!/usr/bin/python3 -u
 
-import msfinance as msf
-
-proxy = 'socks5://127.0.0.1:1088'
-
-stock = msf.Stock(
-    debug=True,
-    database='sp500.db3',
-    proxy=proxy,
-)
-
-tickers_list = {
-    #'tsla', # Tesla
-    #'intc', # Intel
-    #'amd', # AMD
-    #'googl', # Google
-    #'msft', # Microsoft
-    #'amzn', # Amazon
-    #'nvda', # Nvidia
-    #'nflx', # Netflix
-    #'mnst', # Monster Beverage
-    #'sbux', # Starbucks
-}
-
-# XNAS
-for ticker in sorted(tickers_list):
-    key_metrics = stock.get_key_metrics(ticker, 'xnas', update=True)
-    financials = stock.get_financials(ticker, 'xnas', update=True)
-
-    print(f"Ticker: {ticker}")
-    for key_metric in key_metrics:
-        print(key_metric)
-    for financial in financials:
-        print(financial)
-
-tickers_list = {
-    'ko', # Coca-Cola
-}
-
-# XNYS
-for ticker in sorted(tickers_list):
-    key_metrics = stock.get_key_metrics(ticker, 'xnys', update=True)
-    financials = stock.get_financials(ticker, 'xnys', update=True)
-
-    print(f"Ticker: {ticker}")
-    for key_metric in key_metrics:
-        print(key_metric)
-    for financial in financials:
-        print(financial)
+import os
+import sys
+import time
+import queue
+import random
+import sqlite3
+import datetime
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from optparse import OptionParser
+
+# msfinance 的数据表，名称为 '{ticker}_{exchange}_{suffix}'，全部小写
+# 顺序与 Stock.get_key_metrics() / Stock.get_financials() 的返回值相同
+KEY_METRICS = [
+    'Financial Summary',
+    'Growth',
+    'Profitability and Efficiency',
+    'Financial Health',
+    'Cash Flow',
+]
+FINANCIAL_STATEMENTS = [
+    'Income Statement',
+    'Balance Sheet',
+    'Cash Flow',
+]
+FINANCIAL_PERIOD = 'Annual'
+FINANCIAL_STAGE = 'As Originally Reported'
+
+# jmStockAnalysis.py --build-catalog 生成的表名索引，存在时同时更新
+CATALOG_TABLE = 'jm_table_catalog'
+
+def table_name(*parts):
+    return '_'.join(parts).replace(' ', '_').lower()
+
+def sql_value(value):
+    '''
+    与 to_sql() 为 sqlite 注册的转换相同: 日期时间保存为 ISO 格式的字符串
+    '''
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(' ')
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, datetime.time):
+        return f"{value.hour:02d}:{value.minute:02d}:{value.second:02d}.{value.microsecond:06d}"
+    return value
+
+def write_table(db, name, df):
+    '''
+    以 DataFrame 替换数据表，表结构及数值与 DataFrame.to_sql(index=False) 相同。
+    to_sql() 每写一个表提交一次，这里不提交，由调用者在一个事务中写入一个股票的所有表
+
+    Args:
+        db: sqlite3.Connection in a transaction
+        name: Table name
+        df: pandas.DataFrame
+    '''
+    from pandas import isna
+    from pandas.io.sql import get_schema
+
+    db.execute(f'DROP TABLE IF EXISTS "{name}"')
+    db.execute(get_schema(df, name, con=db))
+
+    # 与 to_sql() 相同: datetime64 转为 datetime，timedelta64 保存为纳秒整数，NaN 及 NaT 为 NULL
+    columns = []
+    for i in range(df.shape[1]):
+        series = df.iloc[:, i]
+        if series.dtype.kind == 'M':
+            values = series.array.to_pydatetime()
+        elif series.dtype.kind == 'm':
+            values = series.to_numpy().view('i8').astype(object)
+        else:
+            values = series.to_numpy(dtype=object)
+        if series.dtype.kind != 'm':
+            values[isna(values)] = None
+        columns.append([sql_value(value) for value in values])
+    placeholders = ', '.join('?' * df.shape[1])
+    db.executemany(f'INSERT INTO "{name}" VALUES ({placeholders})', zip(*columns))
+
+def load_tickers(path):
+    '''
+    读取股票列表，每行一个股票: exchange ticker
+    空行及 '#' 之后的注释会被忽略
+
+    Args:
+        path: Ticker list file
+    Returns:
+        List of (exchange, ticker), duplicates removed
+    '''
+    tickers = []
+    with open(path) as file:
+        for lineno, line in enumerate(file, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+
+            fields = line.split()
+            if len(fields) != 2:
+                raise ValueError(f"{path}:{lineno}: expect 'exchange ticker', got '{line}'")
+            entry = (fields[0].lower(), fields[1].lower())
+            if entry not in tickers:
+                tickers.append(entry)
+
+    return tickers
+
+class RateLimiter:
+    '''
+    限制请求频率，两次请求之间至少间隔 interval 秒，可在多个线程间共享
+    '''
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+class Progress:
+    '''
+    更新进度文件，每行一个已完成的 'exchange ticker'，用于中断后继续更新
+    '''
+    def __init__(self, path, restart=False):
+        self.path = path
+        self.done = set()
+        if restart and os.path.exists(path):
+            os.remove(path)
+        if os.path.exists(path):
+            with open(path) as file:
+                self.done = {tuple(line.split()) for line in file if line.strip()}
+
+    def mark(self, exchange, ticker):
+        with open(self.path, 'a') as file:
+            file.write(f"{exchange} {ticker}\n")
+        self.done.add((exchange, ticker))
+
+    def finish(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def default_stock_factory(database, proxy):
+    '''
+    创建 msfinance.Stock，数据先写入该线程自己的临时数据库
+    '''
+    import msfinance as msf
+    return msf.Stock(debug=True, database=database, proxy=proxy)
+
+def fetch_ticker(stock, exchange, ticker, limiter):
+    '''
+    获取单一股票的所有数据
+
+    Returns:
+        List of (table name, DataFrame)
+    '''
+    tables = []
+
+    limiter.wait()
+    key_metrics = stock.get_key_metrics(ticker, exchange, update=True)
+    for statistics, df in zip(KEY_METRICS, key_metrics):
+        if df is not None:
+            tables.append((table_name(ticker, exchange, statistics), df))
+
+    limiter.wait()
+    financials = stock.get_financials(ticker, exchange, update=True)
+    for statement, df in zip(FINANCIAL_STATEMENTS, financials):
+        if df is not None:
+            tables.append((table_name(ticker, exchange, statement, FINANCIAL_PERIOD, FINANCIAL_STAGE), df))
+
+    return tables
+
+def update_tickers(tickers, database, stock_factory, jobs=1, interval=10.0,
+                   retries=3, backoff=60.0, progress=None):
+    '''
+    并发更新股票数据。每个交易所单独限制请求频率，失败时按指数退避重试，
+    所有数据由一个写线程写入数据库
+
+    Args:
+        tickers: List of (exchange, ticker)
+        database: Path of database
+        stock_factory: Callable(scratch database) returning a msfinance.Stock like object,
+                       called once per worker thread
+        jobs: Number of worker threads
+        interval: Minimum seconds between two requests to the same exchange
+        retries: Number of retries of each ticker
+        backoff: Seconds to wait before the first retry, doubled on each retry
+        progress: Progress of last run, None to update all tickers
+    Returns:
+        (List of updated (exchange, ticker), list of failed (exchange, ticker, error message))
+    '''
+    pending = [t for t in tickers if progress is None or t not in progress.done]
+    limiters = {exchange: RateLimiter(interval) for exchange, _ in pending}
+
+    # 每个线程一个 Stock，msfinance 自身的写入落在线程自己的临时数据库中
+    local = threading.local()
+    scratch_dir = tempfile.TemporaryDirectory()
+    stocks = []
+
+    def get_stock():
+        if not hasattr(local, 'stock'):
+            path = os.path.join(scratch_dir.name, f"worker{threading.get_ident()}.db3")
+            local.stock = stock_factory(path)
+            stocks.append(local.stock)
+        return local.stock
+
+    writes = queue.Queue()
+    updated = []
+    failures = []
+
+    def worker(exchange, ticker):
+        for attempt in range(retries + 1):
+            try:
+                tables = fetch_ticker(get_stock(), exchange, ticker, limiters[exchange])
+                writes.put((exchange, ticker, tables))
+                return
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                if attempt < retries:
+                    delay = backoff * 2 ** attempt * random.uniform(1.0, 1.5)
+                    print(f"Retry {ticker} ({exchange}) in {delay:.0f}s: {error}")
+                    time.sleep(delay)
+
+        failures.append((exchange, ticker, error))
+        print(f"Fail {ticker} ({exchange}): {error}")
+
+    def writer():
+        # 手动管理事务，一个股票的所有表在一个事务中替换，失败时全部回滚
+        db = sqlite3.connect(database, isolation_level=None)
+        query = "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?"
+        has_catalog = db.execute(query, (CATALOG_TABLE,)).fetchone() is not None
+        try:
+            while True:
+                item = writes.get()
+                if item is None:
+                    break
+                exchange, ticker, tables = item
+                try:
+                    db.execute('BEGIN')
+                    for name, df in tables:
+                        write_table(db, name, df)
+                    if has_catalog:
+                        db.executemany(f"INSERT OR REPLACE INTO {CATALOG_TABLE} VALUES (?, ?, ?)",
+                                       [(ticker, exchange, name) for name, _ in tables])
+                    db.commit()
+                except Exception as e:
+                    db.rollback()
+                    failures.append((exchange, ticker, f"{type(e).__name__}: {e}"))
+                    print(f"Fail {ticker} ({exchange}): {type(e).__name__}: {e}")
+                    continue
+                if progress is not None:
+                    progress.mark(exchange, ticker)
+                updated.append((exchange, ticker))
+                print(f"Ticker: {ticker} ({exchange}), {len(tables)} tables updated")
+        finally:
+            db.close()
+
+    write_thread = threading.Thread(target=writer)
+    write_thread.start()
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            for exchange, ticker in pending:
+                pool.submit(worker, exchange, ticker)
+    finally:
+        writes.put(None)
+        write_thread.join()
+        stocks.clear()
+        scratch_dir.cleanup()
+
+    return updated, failures
+
+def main():
+    parser = OptionParser()
+
+    parser.add_option("--db", "--database",
+                action="store", dest="database", default='sp500.db3',
+                help="Finance database to update, default sp500.db3")
+    parser.add_option("-l", "--list",
+                action="store", dest="tickers", default='tickers.txt',
+                help="Ticker list, one 'exchange ticker' per line, default tickers.txt")
+    parser.add_option("-j", "--jobs",
+                action="store", dest="jobs", type="int", default=1,
+                help="Number of concurrent workers, default 1")
+    parser.add_option("--proxy",
+                action="store", dest="proxy", default='socks5://127.0.0.1:1088',
+                help="Proxy of msfinance, default socks5://127.0.0.1:1088")
+    parser.add_option("--interval",
+                action="store", dest="interval", type="float", default=10.0,
+                help="Minimum seconds between requests to the same exchange, default 10")
+    parser.add_option("--retries",
+                action="store", dest="retries", type="int", default=3,
+                help="Number of retries of a failed ticker, default 3")
+    parser.add_option("--progress",
+                action="store", dest="progress",
+                help="Progress file to resume an interrupted run, default <database>.progress")
+    parser.add_option("--restart",
+                action="store_true", dest="restart", default=False,
+                help="Ignore the progress of last run, update all tickers")
+
+    (opts, args) = parser.parse_args()
+
+    tickers = load_tickers(opts.tickers)
+    progress = Progress(opts.progress or f"{opts.database}.progress", opts.restart)
+    if progress.done:
+        print(f"Resume, {len(progress.done)} tickers are already updated")
+
+    stock_factory = lambda database: default_stock_factory(database, opts.proxy)
+    updated, failures = update_tickers(tickers, opts.database, stock_factory,
+                                       jobs=opts.jobs, interval=opts.interval,
+                                       retries=opts.retries, progress=progress)
+
+    print(f"{len(updated)} updated, {len(failures)} failed")
+    if failures:
+        sys.exit(1)
+    progress.finish()
+
+
+if __name__ == '__main__':
+    main()